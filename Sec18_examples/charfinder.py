@@ -9,15 +9,48 @@ Here is the ``main`` function which makes it happen::
     >>> main('rook')  # doctest: +NORMALIZE_WHITESPACE
     U+2656  ♖  WHITE CHESS ROOK
     U+265C  ♜  BLACK CHESS ROOK
-    (2 matches for 'rook')
+    U+1FA02  🨂  NEUTRAL CHESS ROOK
+    U+1FA0B  🨋  WHITE CHESS ROOK ROTATED NINETY DEGREES
+    U+1FA11  🨑  BLACK CHESS ROOK ROTATED NINETY DEGREES
+    U+1FA17  🨗  NEUTRAL CHESS ROOK ROTATED NINETY DEGREES
+    U+1FA20  🨠  WHITE CHESS TURNED ROOK
+    U+1FA26  🨦  BLACK CHESS TURNED ROOK
+    U+1FA2C  🨬  NEUTRAL CHESS TURNED ROOK
+    U+1FA35  🨵  WHITE CHESS ROOK ROTATED TWO HUNDRED SEVENTY DEGREES
+    U+1FA3B  🨻  BLACK CHESS ROOK ROTATED TWO HUNDRED SEVENTY DEGREES
+    U+1FA41  🩁  NEUTRAL CHESS ROOK ROTATED TWO HUNDRED SEVENTY DEGREES
+    U+1FA4F  🩏  WHITE CHESS KNIGHT-ROOK
+    U+1FA52  🩒  BLACK CHESS KNIGHT-ROOK
+    (14 matches for 'rook')
     >>> main('rook', 'black')  # doctest: +NORMALIZE_WHITESPACE
     U+265C  ♜  BLACK CHESS ROOK
-    (1 match for 'rook black')
+    U+1FA11  🨑  BLACK CHESS ROOK ROTATED NINETY DEGREES
+    U+1FA26  🨦  BLACK CHESS TURNED ROOK
+    U+1FA3B  🨻  BLACK CHESS ROOK ROTATED TWO HUNDRED SEVENTY DEGREES
+    U+1FA52  🩒  BLACK CHESS KNIGHT-ROOK
+    (5 matches for 'rook black')
     >>> main('white bishop')  # doctest: +NORMALIZE_WHITESPACE
-    U+2657  ♗   WHITE CHESS BISHOP
-    (1 match for 'white bishop')
+    U+2657  ♗  WHITE CHESS BISHOP
+    U+1FA0C  🨌  WHITE CHESS BISHOP ROTATED NINETY DEGREES
+    U+1FA21  🨡  WHITE CHESS TURNED BISHOP
+    U+1FA36  🨶  WHITE CHESS BISHOP ROTATED TWO HUNDRED SEVENTY DEGREES
+    U+1FA50  🩐  WHITE CHESS KNIGHT-BISHOP
+    (5 matches for 'white bishop')
     >>> main("jabberwocky's vest")
     (No match for "jabberwocky's vest")
+
+Codepoints, ranges of codepoints and the characters themselves can be
+looked up too::
+    >>> main('U+2654..U+2656')  # doctest: +NORMALIZE_WHITESPACE
+    U+2654  ♔  WHITE CHESS KING
+    U+2655  ♕  WHITE CHESS QUEEN
+    U+2656  ♖  WHITE CHESS ROOK
+    (3 matches for 'U+2654..U+2656')
+    >>> main('♞♜')  # doctest: +NORMALIZE_WHITESPACE
+    U+265C  ♜  BLACK CHESS ROOK
+    U+265E  ♞  BLACK CHESS KNIGHT
+    (2 matches for '♞♜')
+
 For exploring words that occur in the character names, there is the
 ``word_report`` function::
     >>> index = UnicodeNameIndex(sample_chars)
@@ -33,21 +66,26 @@ For exploring words that occur in the character names, there is the
         1 SMALL
     >>> index = UnicodeNameIndex()
     >>> index.word_report(10)
-    75821 CJK
-    75761 IDEOGRAPH
-    74656 UNIFIED
-    13196 SYLLABLE
+    94070 CJK
+    94010 IDEOGRAPH
+    92905 UNIFIED
+    13422 SYLLABLE
     11735 HANGUL
-     7616 LETTER
-     2232 WITH
-     2180 SIGN
-     2122 SMALL
-     1709 CAPITAL
+    10712 LETTER
+     3358 SIGN
+     3222 SMALL
+     2626 WITH
+     2032 CAPITAL
+
 Note: characters with names starting with 'CJK UNIFIED IDEOGRAPH'
 are indexed with those three words only, excluding the hexadecimal
 codepoint at the end of the name.
+
+Matches and counts depend on the Unicode version of ``unicodedata``;
+the examples above are for Unicode 14.0, as in Python 3.11.
 """
 
+import os
 import sys
 import re
 import unicodedata
@@ -55,14 +93,53 @@ import pickle
 import warnings
 import itertools
 import functools
-from collections import namedtuple
+import bisect
+import heapq
+import math
+import operator
+import threading
+import time
+from concurrent import futures
+from array import array
+from collections import namedtuple, OrderedDict, Counter, deque
+
+from charfinder_store import (MappedIndex, IndexFormatError, DescriptionTable,
+                              BitmapPostings, write_index)
+from charfinder_metrics import NO_METRICS
 
 RE_WORD = re.compile(r'\w+')
-RE_UNICODE_NAME = re.compile('^[A-Z0-9 -]+$')
+RE_WORD_PATTERN = re.compile(r'\w+(?:\*|~[0-9]?)?')
+RE_UNICODE_NAME = re.compile("^[A-Z0-9 '*~|:-]+$")
 RE_CODEPOINT = re.compile('U\+([0-9A-F]{4,6})')
+RE_CODEPOINT_RANGE = re.compile(
+    r'U\+([0-9A-F]{4,6})(?:\.\.(?:U\+)?([0-9A-F]{4,6}))?')
+
+CRLF = b'\r\n'
+DESCRIPTION_FMT = '{:7}\t{}\t{}'
 
 INDEX_NAME = 'charfinder_index.pickle'
+ALIASES_NAME = 'NameAliases.txt'
+COMPACT_INDEX_NAME = 'charfinder_index.bin'
 MINIMUM_SAVE_LEN = 10000
+FIRST_CODEPOINT = 32
+CHUNKS_PER_WORKER = 4  # CJK blocks make chunks uneven, so split finer
+PAGE_SIZE = 20
+BITMAP_THRESHOLD = 4096  # postings at least this long are stored as bitmaps
+CACHE_MAX_CHARS = 500000  # chars held by all cached query results
+BATCH_SIZE = 1024  # queries planned together by find_many
+READY_TIMEOUT = 2.0  # seconds a query waits for a LazyIndex to load
+INLINE_COST = 5000  # postings entries a query may merge on the event loop
+ROW_COST = 5  # postings entries worth the time to format one result row
+COST_SAMPLE = 16  # postings entries probed to estimate a lazy page
+QUERY_LOG_LEN = 1000  # recent query timings kept by a QueryRunner
+NOT_PREFIX = '-'
+OR_SEP = '|'
+PREFIX_MARK = '*'
+FUZZY_MARK = '~'
+SOURCE_PREFIX = 'source:'  # source:alias restricts a query to one source
+SOURCE_SEP = ':'  # index keys of other sources are like alias:WORD
+MAX_EDIT_DISTANCE = 2
+MAX_EXPANSIONS = 50  # words added by all * and ~ patterns of one query
 CJK_UNI_PREFIX = 'CJK UNIFIED IDEOGRAPH'
 CJK_CMP_PREFIX = 'CJK COMPATIBILITY IDEOGRAPH'
 
@@ -78,6 +155,16 @@ CharDescription = namedtuple('CharDescription', 'code_str char name')
 
 QueryResult = namedtuple('QueryResult', 'count items')
 
+QueryPage = namedtuple('QueryPage', 'items cursor')
+
+PlanStep = namedtuple('PlanStep', 'op term estimated actual')
+
+CacheStats = namedtuple('CacheStats', 'hits misses evictions entries chars')
+
+SourceStats = namedtuple('SourceStats', 'source words postings seconds')
+
+QueryTiming = namedtuple('QueryTiming', 'query cost offloaded wall blocking')
+
 
 def tokenize(text):
     """return iterable of uppercased words"""
@@ -85,6 +172,214 @@ def tokenize(text):
         yield match.group().upper()
 
 
+def tokenize_patterns(text):
+    """like tokenize, but keep the * and ~ marks of CHES* and BISHOPP~"""
+    for match in RE_WORD_PATTERN.finditer(text):
+        yield match.group().upper()
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 if greater
+
+        >>> edit_distance('BISHOPP', 'BISHOP', 2)
+        1
+        >>> edit_distance('ROOK', 'BISHOP', 2)
+        3
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:  # every path is already too long
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class Vocabulary:
+    """the sorted words of an index, for prefix and typo-tolerant lookup"""
+
+    def __init__(self, words):
+        self.words = sorted(words)
+
+    def prefix(self, prefix, limit=MAX_EXPANSIONS):
+        """return up to limit words starting with prefix, in order"""
+        result = []
+        start = bisect.bisect_left(self.words, prefix)
+        for i in range(start, min(start + limit, len(self.words))):
+            if not self.words[i].startswith(prefix):
+                break
+            result.append(self.words[i])
+        return result
+
+    def fuzzy(self, word, distance=1, limit=MAX_EXPANSIONS):
+        """return up to limit words within distance edits, closest first
+
+        The sorted words are walked as an implicit trie: consecutive words
+        share the edit distance rows of their common prefix, and once every
+        cell of a row exceeds distance, all words with that prefix are
+        skipped with one bisect.
+        """
+        words = self.words
+        found = []
+        rows = [list(range(len(word) + 1))]  # rows[k]: after k chars of prev
+        prev = ''
+        i = 0
+        while i < len(words):
+            candidate = words[i]
+            shared = 0
+            limit_shared = min(len(prev), len(candidate))
+            while (shared < limit_shared and
+                   prev[shared] == candidate[shared]):
+                shared += 1
+            del rows[shared + 1:]
+            for depth in range(shared, len(candidate)):
+                above = rows[depth]
+                char = candidate[depth]
+                row = [depth + 1]
+                for j, word_char in enumerate(word, 1):
+                    row.append(min(above[j] + 1, row[j - 1] + 1,
+                                   above[j - 1] + (word_char != char)))
+                rows.append(row)
+                if min(row) > distance:  # no word with this prefix can match
+                    prev = candidate[:depth + 1]
+                    following = prev[:-1] + chr(ord(prev[-1]) + 1)
+                    i = bisect.bisect_left(words, following, i + 1)
+                    break
+            else:
+                if rows[-1][-1] <= distance:
+                    found.append((rows[-1][-1], candidate))
+                prev = candidate
+                i += 1
+        found.sort()
+        return [candidate for _, candidate in found[:limit]]
+
+
+class WordRank:
+    """index words by descending postings count, then alphabetically
+
+    ``words`` are the index words in sorted order, ``counts`` their
+    postings counts, and ``order`` the positions of the words in rank
+    order. The order is computed once per index and saved with it.
+    """
+
+    def __init__(self, words, counts, order=None):
+        self.words = words
+        self.counts = counts
+        if order is None:
+            order = array('I', sorted(range(len(words)),
+                                      key=lambda i: (-counts[i], words[i])))
+        self.order = order
+        self._positions = None
+
+    @classmethod
+    def from_index(cls, index, order=None):
+        """WordRank of a dict or MappedIndex of word -> postings"""
+        if isinstance(index, MappedIndex):
+            return cls(index.words, index.counts, order)
+        words = sorted(index)
+        return cls(words, array('I', (len(index[word]) for word in words)),
+                   order)
+
+    def positions(self):
+        """rank of each word, by position of the word; built on first use"""
+        if self._positions is None:
+            positions = array('I', bytes(4 * len(self.order)))
+            for rank, i in enumerate(self.order):
+                positions[i] = rank
+            self._positions = positions
+        return self._positions
+
+    def iter_rank(self, prefix=''):
+        """yield (count, word) pairs in rank order, of words with prefix
+
+        Without prefix, the rank table is walked, so the first k pairs
+        cost O(k). With prefix, the ranks of the matching words are
+        heapified and popped as needed: O(m + k log m) for m matches.
+        """
+        order, counts, words = self.order, self.counts, self.words
+        if not prefix:
+            for i in order:
+                yield counts[i], words[i]
+            return
+        following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        lo = bisect.bisect_left(words, prefix)
+        hi = bisect.bisect_left(words, following, lo)
+        ranks = self.positions()[lo:hi].tolist()
+        heapq.heapify(ranks)
+        while ranks:
+            i = order[heapq.heappop(ranks)]
+            yield counts[i], words[i]
+
+
+class Term(namedtuple('Term', 'words negated')):
+    """one query term: the union of its words, possibly negated"""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return (NOT_PREFIX if self.negated else '') + OR_SEP.join(self.words)
+
+
+def parse_query(text):
+    """return list of Term: words, -negated words and WORD|WORD groups
+
+    Words may end with * (prefix) or ~ (typo, optionally ~2 for two edits);
+    those patterns are expanded later by QueryPlan.
+
+        >>> [str(term) for term in parse_query('chess -white rook|pawn')]
+        ['CHESS', '-WHITE', 'ROOK|PAWN']
+        >>> [str(term) for term in parse_query('ches* bishopp~')]
+        ['CHES*', 'BISHOPP~']
+    """
+    terms = []
+    for chunk in text.split():
+        if chunk.lower().startswith(SOURCE_PREFIX):  # see query_sources
+            continue
+        negated = chunk.startswith(NOT_PREFIX)
+        if negated:
+            chunk = chunk[len(NOT_PREFIX):]
+        if OR_SEP in chunk:
+            words = tuple(tokenize_patterns(chunk))
+            if words:
+                terms.append(Term(words, negated))
+        else:  # hyphenated words like EURO-CURRENCY are separate terms
+            terms.extend(Term((word,), negated)
+                         for word in tokenize_patterns(chunk))
+    return terms
+
+
+def query_sources(text):
+    """return names of the sources a query is restricted to, or ()
+
+        >>> query_sources('source:alias zwj Source:Folded')
+        ('alias', 'folded')
+    """
+    return tuple(chunk[len(SOURCE_PREFIX):].lower() for chunk in text.split()
+                 if chunk.lower().startswith(SOURCE_PREFIX))
+
+
+def query_key(text):
+    """normalized terms of a query: 'black rook' and 'rook black' match
+
+        >>> query_key('rook black') == query_key('Black  ROOK')
+        True
+        >>> query_key('♜♞') == query_key('♞ ♜')
+        True
+    """
+    kind = query_type(text)
+    if kind == 'CODEPOINT':
+        return (kind,) + tuple(sorted(set(parse_codepoints(text))))
+    elif kind == 'CHARACTERS':
+        return (kind,) + tuple(literal_codes(text))
+    sources = {SOURCE_PREFIX + name for name in query_sources(text)}
+    return tuple(sorted({str(term) for term in parse_query(text)} | sources))
+
+
 def query_type(text):
     text_upper = text.upper()
     if 'U+' in text_upper:
@@ -95,19 +390,723 @@ def query_type(text):
         return 'CHARACTERS'
 
 
+def parse_codepoints(text):
+    """return list of (first, last) codepoints in U+XXXX and U+XXXX..U+YYYY
+
+        >>> parse_codepoints('U+1F600 u+2650..U+265F')
+        [(128512, 128512), (9808, 9823)]
+    """
+    ranges = []
+    for match in RE_CODEPOINT_RANGE.finditer(text.upper()):
+        first = int(match.group(1), 16)
+        last = first if match.group(2) is None else int(match.group(2), 16)
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def literal_codes(text):
+    """return sorted codepoints of the chars in text, except whitespace"""
+    return sorted({ord(char) for char in text if not char.isspace()})
+
+
+def description_line(char):
+    """return description of char as UTF-8 bytes ending with CRLF"""
+    code_str = 'U+{:04X}'.format(ord(char))
+    text = DESCRIPTION_FMT.format(code_str, char, unicodedata.name(char))
+    return text.encode('utf-8') + CRLF
+
+
+def build_descriptions(codes):
+    """return DescriptionTable with a line for each of the sorted codes"""
+    codes = array('I', codes)
+    offsets = array('I', [0])
+    lines = []
+    end = 0
+    for code in codes:
+        line = description_line(chr(code))
+        lines.append(line)
+        end += len(line)
+        offsets.append(end)
+    return DescriptionTable(codes, offsets, b''.join(lines))
+
+
+def merge_descriptions(previous, new_codes):
+    """return DescriptionTable of previous plus lines for sorted new_codes
+
+    Runs of previous lines between new codes are copied in one slice each.
+    """
+    old_codes, old_offsets, old_text = (previous.codes, previous.offsets,
+                                        previous.text)
+    codes = array('I')
+    offsets = array('I', [0])
+    chunks = []
+    i = 0
+    for code in itertools.chain(new_codes, [None]):
+        j = len(old_codes) if code is None else bisect.bisect_left(
+            old_codes, code, i)
+        if j > i:  # copy previous lines i to j - 1
+            start, stop = old_offsets[i], old_offsets[j]
+            shift = offsets[-1] - start
+            codes.extend(old_codes[i:j])
+            offsets.extend(offset + shift
+                           for offset in old_offsets[i + 1:j + 1])
+            chunks.append(old_text[start:stop])
+            i = j
+        if code is not None:
+            line = description_line(chr(code))
+            codes.append(code)
+            offsets.append(offsets[-1] + len(line))
+            chunks.append(line)
+    return DescriptionTable(codes, offsets, b''.join(chunks))
+
+
+def index_words(char):
+    """return words under which char is indexed, or () if it has no name"""
+    try:
+        name = unicodedata.name(char)
+    except ValueError:
+        return ()
+    if name.startswith(CJK_UNI_PREFIX):
+        name = CJK_UNI_PREFIX
+    elif name.startswith(CJK_CMP_PREFIX):
+        name = CJK_CMP_PREFIX
+    return tokenize(name)
+
+
+class NameSource:
+    """names under which chars are indexed, in a namespace of the index
+
+    Subclasses implement ``words``. Index keys of a source are its words
+    prefixed with its lowercase ``namespace``, like ``alias:ZWJ``, so they
+    sort apart from the uppercase words of official names, which are the
+    only keys without a namespace. Only named chars are indexed.
+    """
+
+    name = None
+    namespace = ''
+
+    def words(self, char):
+        """return uppercase words under which char is indexed"""
+        raise NotImplementedError
+
+    def candidates(self, first, last):
+        """return codepoints in range(first, last) that may have words"""
+        return range(first, last)
+
+    def key(self, word):
+        return self.namespace + word
+
+    def owns(self, key):
+        """True if key is an index key of this source"""
+        if self.namespace:
+            return key.startswith(self.namespace)
+        return SOURCE_SEP not in key
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(type(self).__name__, self.name)
+
+
+class OfficialNames(NameSource):
+    """words of unicodedata.name, see index_words"""
+
+    name = 'name'
+
+    def words(self, char):
+        return index_words(char)
+
+
+class AliasNames(NameSource):
+    """formal aliases read from a file in the format of NameAliases.txt
+
+    Lines are ``code;alias;type``; comments start with #. Aliases of
+    unnamed codepoints, like control chars, are not indexed.
+    """
+
+    name = 'alias'
+    namespace = 'alias' + SOURCE_SEP
+
+    def __init__(self, path=ALIASES_NAME):
+        self.path = path
+        self.aliases = load_aliases(path)
+
+    def words(self, char):
+        return [word for alias in self.aliases.get(ord(char), ())
+                for word in tokenize(alias)]
+
+    def candidates(self, first, last):
+        return sorted(code for code in self.aliases if first <= code < last)
+
+
+class FoldedNames(NameSource):
+    """ASCII words of the char itself, casefolded and without accents
+
+    For example, 'é' and '\u212f' (SCRIPT SMALL E) are indexed as folded:E,
+    '\u338f' (SQUARE KG) as folded:KG.
+    """
+
+    name = 'folded'
+    namespace = 'folded' + SOURCE_SEP
+
+    def words(self, char):
+        return [word.upper() for word in RE_WORD.findall(fold(char))
+                if word.isascii()]
+
+
+DEFAULT_SOURCES = (OfficialNames(),)
+
+
+def fold(text):
+    """NFKD-normalize text, drop combining marks, then casefold"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed
+                   if not unicodedata.combining(char)).casefold()
+
+
+def load_aliases(path):
+    """return dict codepoint -> list of aliases from a NameAliases.txt file"""
+    aliases = {}
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            line = line.partition('#')[0].strip()
+            if not line:
+                continue
+            code, alias, *_ = line.split(';')
+            aliases.setdefault(int(code, 16), []).append(alias.strip())
+    return aliases
+
+
+def source_postings(source, codes):
+    """return dict index key -> array('I') of the named codes, from source"""
+    postings = {}
+    for code in codes:
+        char = chr(code)
+        if unicodedata.name(char, None) is None:
+            continue
+        for word in set(source.words(char)):  # names may repeat a word
+            postings.setdefault(source.key(word), array('I')).append(code)
+    return postings
+
+
+def range_postings(bounds, source=DEFAULT_SOURCES[0]):
+    """return dict index key -> array('I') of codepoints in range(*bounds)"""
+    return source_postings(source, source.candidates(*bounds))
+
+
+def new_postings(known_codes, sources=DEFAULT_SOURCES):
+    """return dict index key -> codepoints of named chars not in known_codes
+
+    Unicode names never change once assigned, so after a Unicode upgrade
+    only codepoints unknown to the old index need to be tokenized.
+    """
+    postings = {}
+    for source in sources:
+        codes = source.candidates(FIRST_CODEPOINT, sys.maxunicode)
+        postings.update(source_postings(
+            source, (code for code in codes if code not in known_codes)))
+    return postings
+
+
+def parallel_postings(workers, sources=DEFAULT_SOURCES):
+    """yield (source, partial postings) built by a process pool
+
+    Partial postings of each source come in codepoint order: each covers
+    a contiguous codepoint range, so concatenating the partial postings
+    of a word keeps them sorted.
+    """
+    chunk_count = workers * CHUNKS_PER_WORKER
+    size = -(-(sys.maxunicode - FIRST_CODEPOINT) // chunk_count)
+    bounds = [(lo, min(lo + size, sys.maxunicode))
+              for lo in range(FIRST_CODEPOINT, sys.maxunicode, size)]
+    with futures.ProcessPoolExecutor(workers) as executor:
+        for source in sources:
+            task = functools.partial(range_postings, source=source)
+            for partial in executor.map(task, bounds):
+                yield source, partial
+
+
+def source_index_name(index_name, sources):
+    """index file name for sources: the default sources use index_name
+
+        >>> source_index_name('index.bin', [OfficialNames(), FoldedNames()])
+        'index-name-folded.bin'
+    """
+    names = [source.name for source in sources]
+    if names == [source.name for source in DEFAULT_SOURCES]:
+        return index_name
+    root, ext = os.path.splitext(index_name)
+    return '{}-{}{}'.format(root, '-'.join(source.name for source in sources),
+                            ext)
+
+
+def gallop(seq, target, lo=0):
+    """return first position >= lo where seq[pos] >= target"""
+    n = len(seq)
+    hi = lo
+    step = 1
+    while hi < n and seq[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(seq, target, lo, min(hi, n))
+
+
+def contains(postings, code):
+    """code in sorted array or BitmapPostings, by bisection for arrays"""
+    if isinstance(postings, BitmapPostings):
+        return code in postings
+    pos = bisect.bisect_left(postings, code)
+    return pos < len(postings) and postings[pos] == code
+
+
+def intersect_sorted(a, b):
+    """intersect two sorted codepoint sequences, galloping in the longer"""
+    if len(a) > len(b):
+        a, b = b, a
+    result = array('I')
+    pos = 0
+    n = len(b)
+    for code in a:
+        pos = gallop(b, code, pos)
+        if pos == n:
+            break
+        if b[pos] == code:
+            result.append(code)
+            pos += 1
+    return result
+
+
+def iter_from(postings, first_code):
+    """yield codepoints >= first_code of sorted array or BitmapPostings"""
+    if isinstance(postings, BitmapPostings):
+        return postings.iter_from(first_code)
+    start = bisect.bisect_left(postings, first_code)
+    return itertools.islice(postings, start, None)
+
+
+def iter_intersection(postings, first_code=0):
+    """lazily yield codepoints >= first_code common to all postings
+
+    The shortest postings drive; sorted arrays are galloped through and
+    bitmaps are probed.
+    """
+    postings = sorted(postings, key=len)
+    driver = postings[0]
+    arrays = [seq for seq in postings[1:]
+              if not isinstance(seq, BitmapPostings)]
+    bitmaps = [seq for seq in postings[1:] if isinstance(seq, BitmapPostings)]
+    positions = [0] * len(arrays)
+    for code in iter_from(driver, first_code):
+        for j, seq in enumerate(arrays):
+            pos = positions[j] = gallop(seq, code, positions[j])
+            if pos == len(seq):
+                return
+            if seq[pos] != code:
+                break
+        else:
+            if all(code in bitmap for bitmap in bitmaps):
+                yield code
+
+
+def compact_postings(codes, threshold=BITMAP_THRESHOLD):
+    """return sorted codes as array('I'), or BitmapPostings if frequent"""
+    if threshold is not None and len(codes) >= threshold:
+        return BitmapPostings.from_codes(codes)
+    return codes if isinstance(codes, array) else array('I', codes)
+
+
+def difference_sorted(a, b):
+    """codepoints of sorted a not in sorted b"""
+    result = array('I')
+    pos = 0
+    n = len(b)
+    for code in a:
+        pos = gallop(b, code, pos)
+        if pos == n or b[pos] != code:
+            result.append(code)
+    return result
+
+
+def union_sorted(postings):
+    """merge sorted codepoint sequences, dropping duplicates"""
+    if len(postings) == 1:
+        return postings[0]
+    result = array('I')
+    last = None
+    for code in heapq.merge(*postings):
+        if code != last:
+            result.append(code)
+            last = code
+    return result
+
+
+class QueryPlan:
+    """evaluate a parsed query against an index, most selective term first
+
+    Positive terms are ordered by estimated cardinality (postings length,
+    summed over the words of an OR group) and intersected; evaluation
+    stops as soon as the running result is empty. Negated terms are then
+    subtracted, largest first, so the result shrinks as early as possible.
+    Prefix (CHES*) and typo (BISHOPP~) patterns become OR groups of the
+    matching index words, at most MAX_EXPANSIONS words per query. A pattern
+    matching no word, or expanded after the budget is spent, becomes a term
+    with no words: its postings, and the result of the query, are empty.
+    The estimate of each step is an upper bound: the smallest estimate of
+    the terms intersected so far.
+
+    Plans of a batch may share pattern expansions, and a memo of term
+    postings and partial results keyed by the set of terms applied so far.
+    Terms shared by several queries of the batch then go first, so their
+    intersection is computed once and reused (op HIT).
+
+    Each word is looked up in the namespaces of all name sources of the
+    index, or of those named by source: in the query, and becomes an OR
+    group of the index keys found: ZWJ may become ZWJ|alias:ZWJ.
+    """
+
+    def __init__(self, index, query, expansions=None):
+        self.index = index
+        self.query = query
+        names = query_sources(query)
+        self.sources = [source for source in index.sources
+                        if not names or source.name in names]
+        self.expansions = {} if expansions is None else expansions
+        self.found = {}  # word -> postings, looked up once per plan
+        self.terms = self.expand(parse_query(query))
+        self.estimates = {term: self.estimate(term) for term in self.terms}
+        self.steps = None
+        self.result = None
+
+    def expand(self, terms):
+        if not self.sources:  # restricted to sources the index lacks
+            return []
+        budget = MAX_EXPANSIONS
+        expanded = []
+        for term in terms:
+            words = []
+            for word in term.words:
+                keys = []
+                for source in self.sources:
+                    found = self.expand_pattern(source, word, budget)
+                    if found is None:  # a plain word
+                        keys.append(source.key(word))
+                    else:
+                        budget -= len(found)
+                        keys.extend(found)
+                if len(keys) > 1:  # keep keys some source actually has
+                    keys = [key for key in keys
+                            if key in self.index.index] or keys[:1]
+                words.extend(keys)
+            expanded.append(Term(tuple(words), term.negated))
+        return expanded
+
+    def expand_pattern(self, source, word, budget):
+        """return up to budget index keys of source matching pattern word
+
+        Return None if word is not a pattern.
+        """
+        if not word.endswith(PREFIX_MARK) and FUZZY_MARK not in word:
+            return None
+        key = source.name, word, budget
+        found = self.expansions.get(key)
+        if found is None:
+            vocabulary = self.index.vocabulary()
+            if word.endswith(PREFIX_MARK):
+                found = vocabulary.prefix(source.key(word[:-1]), budget)
+            else:
+                word, _, distance = word.partition(FUZZY_MARK)
+                distance = min(int(distance or 1), MAX_EDIT_DISTANCE)
+                found = vocabulary.fuzzy(source.key(word), distance, budget)
+            found = [word for word in found if source.owns(word)]
+            self.expansions[key] = found
+        return found
+
+    def estimate(self, term):
+        return sum(len(self.lookup(word)) for word in term.words)
+
+    def lookup(self, word):
+        postings = self.found.get(word)
+        if postings is None:
+            postings = self.found[word] = self.index.postings(word)
+        return postings
+
+    def ordered_terms(self, shared=None):
+        """positive terms, most selective first, then negated terms
+
+        shared: Counter of terms over a batch; terms in more than one
+        query of the batch go first, most shared first.
+        """
+        def rank(term):
+            count = shared[term] if shared else 0
+            return (-count if count > 1 else 0, self.estimates[term],
+                    str(term))
+
+        positive = sorted((t for t in self.terms if not t.negated), key=rank)
+        negative = sorted((t for t in self.terms if t.negated),
+                          key=self.estimates.__getitem__, reverse=True)
+        return positive + negative
+
+    def postings(self, term, memo):
+        if not term.words:  # a pattern that matched no word
+            return self.index.empty()
+        postings = memo.get(term.words)
+        if postings is None:
+            postings = memo[term.words] = self.index.union(
+                [self.lookup(word) for word in term.words])
+        return postings
+
+    def conjunction(self):
+        """postings of a plain multi-word AND query, most selective first
+
+        Return an empty list if the result is empty because a positive
+        term has no words, else None if the query has negated terms or OR
+        groups::
+
+            >>> index = UnicodeNameIndex(sample_chars)
+            >>> index.plan('sign zzz*').conjunction()
+            []
+            >>> index.find_chars('sign zzz*').count
+            0
+            >>> index.find_chars('euro qqqqqq~').count
+            0
+
+        Patterns after the MAX_EXPANSIONS budget is spent match nothing:
+
+            >>> ascii = UnicodeNameIndex([chr(code)
+            ...                           for code in range(32, 127)])
+            >>> plan = ascii.plan('s* c* l* a* t* e* f* p* d* sign*')
+            >>> plan.terms[-1], plan.conjunction()
+            (Term(words=(), negated=False), [])
+            >>> len(plan.execute())
+            0
+        """
+        if any(not term.words and not term.negated for term in self.terms):
+            return []
+        if any(term.negated or len(term.words) > 1 for term in self.terms):
+            return None
+        return [self.lookup(term.words[0])
+                for term in self.ordered_terms()]
+
+    def execute(self, memo=None, shared=None):
+        """return result set or sorted array of the query, recording steps
+
+        memo and shared are given by find_many to the plans of a batch.
+        """
+        if self.steps is not None:
+            return self.result
+        index = self.index
+        memo = {} if memo is None else memo
+        self.steps = []
+        result = None
+        estimated = 0
+        applied = frozenset()
+        for term in self.ordered_terms(shared):
+            term_estimate = self.estimates[term]
+            if result is not None and len(result) == 0:  # short circuit
+                self.steps.append(PlanStep('SKIP', term, 0, None))
+                continue
+            if term.negated and result is None:  # nothing to subtract from
+                break
+            if not term.negated:
+                estimated = (term_estimate if result is None
+                             else min(estimated, term_estimate))
+            applied = applied | {term}
+            if len(applied) > 1 and applied in memo:
+                op = 'HIT'
+                result = memo[applied]
+            elif term.negated:
+                op = 'NOT'
+                result = index.difference(result, self.postings(term, memo))
+            elif result is None:
+                op = 'SCAN'
+                result = self.postings(term, memo)
+            else:
+                op = 'AND'
+                result = index.intersection(result, self.postings(term, memo))
+            memo[applied] = result
+            self.steps.append(PlanStep(op, term, estimated, len(result)))
+        self.result = index.empty() if result is None else result
+        return self.result
+
+    def explain(self):
+        """return a report of each step with estimated and actual counts"""
+        self.execute()
+        lines = ['{:4} {:24} {:>8} {:>8}'.format('op', 'term',
+                                                 'estimate', 'actual')]
+        for step in self.steps:
+            actual = '-' if step.actual is None else step.actual
+            lines.append('{:4} {:24} {:8} {:>8}'.format(
+                step.op, str(step.term), step.estimated, actual))
+        return '\n'.join(lines)
+
+
+class ResultCache:
+    """LRU cache of query results, bounded by the number of chars held
+
+    A result holds as many chars as its length, 1 if empty. When a put
+    goes over max_chars, the least recently used results are evicted::
+
+        >>> cache = ResultCache(max_chars=5)
+        >>> cache.put('A', [65, 97])
+        >>> cache.put('B', [66, 98])
+        >>> cache.get('A')
+        [65, 97]
+        >>> cache.put('C', [67, 99])
+        >>> 'A' in cache, 'B' in cache, 'C' in cache
+        (True, False, True)
+        >>> cache.get('B') is None
+        True
+        >>> cache.stats()
+        CacheStats(hits=1, misses=1, evictions=1, entries=2, chars=4)
+        >>> cache.put('D', list(range(6)))  # bigger than the whole cache
+        >>> 'D' in cache
+        False
+
+    Replacing the index of a UnicodeNameIndex clears its cache::
+
+        >>> index = UnicodeNameIndex(sample_chars)
+        >>> index.find_chars('sign').count
+        3
+        >>> query_key('sign') in index.cache
+        True
+        >>> index.index = dict(index.index)
+        >>> query_key('sign') in index.cache
+        False
+    """
+
+    def __init__(self, max_chars=CACHE_MAX_CHARS):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()  # queries may run in executor threads
+
+    @staticmethod
+    def size(result):
+        return max(len(result), 1)  # empty results still take an entry
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return result
+
+    def __contains__(self, key):  # a peek: not counted as a hit or miss
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, result):
+        size = self.size(result)
+        if size > self.max_chars:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.chars -= self.size(old)
+            self.entries[key] = result
+            self.chars += size
+            while self.chars > self.max_chars:
+                _, evicted = self.entries.popitem(last=False)
+                self.chars -= self.size(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions,
+                          len(self.entries), self.chars)
+
+
+def encode_cursor(char):
+    """cursor pointing just after char: its codepoint in hex"""
+    return '{:X}'.format(ord(char))
+
+
+def decode_cursor(cursor):
+    """return first codepoint after cursor; ValueError if malformed"""
+    return 0 if cursor is None else int(cursor, 16) + 1
+
+
 class UnicodeNameIndex:
 
-    def __init__(self, chars=None):
+    index_name = INDEX_NAME
+
+    def __init__(self, chars=None, workers=None,
+                 cache_max_chars=CACHE_MAX_CHARS, sources=None, metrics=None):
+        self.workers = workers  # build processes; None or 1 builds serially
+        self.cache = ResultCache(cache_max_chars)
+        # charfinder_metrics.Metrics timing the stages of each query:
+        # tokenize, lookup, intersect and sort
+        self.metrics = NO_METRICS if metrics is None else metrics
+        # NameSource instances; other sources are saved in another file
+        self.sources = tuple(sources) if sources else DEFAULT_SOURCES
+        self.index_name = source_index_name(self.index_name, self.sources)
+        self.build_times = {}  # source name -> seconds, if built here
         self.load(chars)
 
+    @property
+    def index(self):
+        return self._index
+
+    @index.setter
+    def index(self, value):
+        # everything derived from the index is stale when it is replaced
+        self._index = value
+        self._vocabulary = None
+        self._descriptions = None
+        self._ranks = None
+        self.cache.clear()
+
+    def descriptions(self):
+        """return DescriptionTable of the indexed chars
+
+        A mapped index carries its table; otherwise it is built on first use.
+        """
+        if self._descriptions is None:
+            self._descriptions = getattr(self.index, 'descriptions', None)
+        if self._descriptions is None:
+            self._descriptions = build_descriptions(self.indexed_codes())
+        return self._descriptions
+
+    def indexed_codes(self):
+        chars = set(itertools.chain.from_iterable(self.index.values()))
+        return sorted(map(ord, chars))
+
+    def ranks(self):
+        """return WordRank of the index, saved with it or built on first use"""
+        if self._ranks is None:
+            self._ranks = WordRank.from_index(
+                self.index, getattr(self.index, 'ranks', None))
+        return self._ranks
+
+    def vocabulary(self):
+        """return Vocabulary of the index words, built on first use"""
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(self.index)
+        return self._vocabulary
+
     def load(self, chars=None):
         self.index = None
         if chars is None:
             try:
-                with open(INDEX_NAME, 'rb') as fp:
-                    self.index = pickle.load(fp)
+                with open(self.index_name, 'rb') as fp:
+                    stored = pickle.load(fp)
             except OSError:
                 pass
+            else:
+                if isinstance(stored, dict):  # saved before versioning
+                    stored = (None, stored)
+                self.unidata_version, self.index, *ranks = stored
+                if ranks:  # saved with a rank table
+                    self._ranks = WordRank.from_index(self.index, ranks[0])
+                if self.unidata_version != unicodedata.unidata_version:
+                    self.update_index()
         if self.index is None:
             self.build_index(chars)
         if len(self.index) > MINIMUM_SAVE_LEN:
@@ -115,60 +1114,325 @@ class UnicodeNameIndex:
                 self.save()
             except OSError as exc:
                 warnings.warn('Could not save {!r}: {}'
-                              .format(INDEX_NAME, exc))
+                              .format(self.index_name, exc))
 
     def save(self):
-        with open(INDEX_NAME, 'wb') as fp:
-            pickle.dump(self.index, fp)
+        with open(self.index_name, 'wb') as fp:
+            pickle.dump((self.unidata_version, self.index,
+                         self.ranks().order), fp)
+
+    def update_index(self):
+        """add chars named since the index was built; return how many"""
+        delta = new_postings(set(self.indexed_codes()), self.sources)
+        added = len(set(itertools.chain.from_iterable(delta.values())))
+        self.merge_postings(delta)
+        self.unidata_version = unicodedata.unidata_version
+        return added
+
+    def merge_postings(self, delta):
+        index = dict(self.index)
+        for word, codes in delta.items():
+            index[word] = index.get(word, set()) | set(map(chr, codes))
+        self.index = index  # a new index object resets derived data
+
+    def parallel_build(self, chars):
+        return chars is None and self.workers is not None and self.workers > 1
+
+    def iter_postings(self, chars=None):
+        """yield (source, partial postings) of each source, in order
+
+        The time spent on each source, including what the caller does
+        with its postings, is recorded in build_times.
+        """
+        self.build_times = dict.fromkeys(
+            (source.name for source in self.sources), 0.0)
+        if self.parallel_build(chars):
+            partials = parallel_postings(self.workers, self.sources)
+        else:
+            codes = None if chars is None else sorted(set(map(ord, chars)))
+            partials = ((source, source_postings(
+                source, source.candidates(FIRST_CODEPOINT, sys.maxunicode)
+                if codes is None else codes)) for source in self.sources)
+        t0 = time.perf_counter()
+        for source, postings in partials:
+            yield source, postings
+            t1 = time.perf_counter()
+            self.build_times[source.name] += t1 - t0
+            t0 = t1
 
     def build_index(self, chars=None):
-        if chars is None:
-            chars = (chr(i) for i in range(32, sys.maxunicode))
+        self.unidata_version = unicodedata.unidata_version
         index = {}
-        for char in chars:
-            try:
-                name = unicodedata.name(char)
-            except ValueError:
-                continue
-            if name.startswith(CJK_UNI_PREFIX):
-                name = CJK_UNI_PREFIX
-            elif name.startswith(CJK_CMP_PREFIX):
-                name = CJK_CMP_PREFIX
+        for _, partial in self.iter_postings(chars):
+            for word, codes in partial.items():
+                index.setdefault(word, set()).update(map(chr, codes))
+        self.index = index
 
-            for word in tokenize(name):
-                index.setdefault(word, set()).add(char)
+    def source_stats(self):
+        """return SourceStats of each source: index keys, postings, seconds
 
-        self.index = index
+        seconds is None unless this instance built the index.
+        """
+        totals = {source.name: [0, 0] for source in self.sources}
+        ranks = self.ranks()
+        for word, count in zip(ranks.words, ranks.counts):
+            for source in self.sources:
+                if source.owns(word):
+                    totals[source.name][0] += 1
+                    totals[source.name][1] += count
+                    break
+        return [SourceStats(name, words, postings, self.build_times.get(name))
+                for name, (words, postings) in totals.items()]
+
+    def source_report(self):
+        print('{:8} {:>8} {:>10} {:>8}'.format('source', 'words', 'postings',
+                                               'build s'))
+        for stats in self.source_stats():
+            seconds = '-' if stats.seconds is None else format(stats.seconds,
+                                                              '.3f')
+            print('{:8} {:8} {:10} {:>8}'.format(stats.source, stats.words,
+                                                 stats.postings, seconds))
+
+    def word_rank(self, top=None, prefix=None):
+        """return up to top (postings count, word) pairs, most frequent first
 
-    def word_rank(self, top=None):
-        res = [(len(self.index[key]), key) for key in self.index]
-        res.sort(key=lambda item: (-item[0], item[1]))
-        if top is not None:
-            res = res[:top]
-        return res
+        Read from the rank table in O(top); with prefix, only words
+        starting with it are ranked, see WordRank.iter_rank. Words are
+        matched in any case; a source namespace like ``folded:`` too::
 
-    def word_report(self, top=None):
-        for postings, key in self.word_rank(top):
+            >>> index = UnicodeNameIndex(sample_chars + ['\u00e9'],
+            ...                          sources=DEFAULT_SOURCES +
+            ...                                  (FoldedNames(),))
+            >>> index.word_rank(2, 'euro')
+            [(2, 'EURO')]
+            >>> index.word_rank(None, 'folded:')
+            [(2, 'folded:A'), (1, 'folded:E')]
+            >>> index.word_rank(None, 'Folded:e')
+            [(1, 'folded:E')]
+        """
+        namespace, sep, word = (prefix or '').rpartition(SOURCE_SEP)
+        ranked = self.ranks().iter_rank(namespace.lower() + sep + word.upper())
+        return list(itertools.islice(ranked, top))
+
+    def word_report(self, top=None, prefix=None):
+        for postings, key in self.word_rank(top, prefix):
             print('{:5} {}'.format(postings, key))
 
-    def find_chars(self, query, start=0, stop=None):
+    def postings(self, word):
+        return self.index.get(word, self.empty())
+
+    def plan(self, query, expansions=None):
+        """return QueryPlan for query; see QueryPlan.explain()"""
+        return QueryPlan(self, query, expansions)
+
+    def search(self, query):
+        """return the whole result of query, from the cache if possible"""
+        with self.metrics.stage('tokenize'):
+            key = query_key(query)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.evaluate(query)
+            self.cache.put(key, result)
+        return result
+
+    def evaluate(self, query):
+        """return the whole result of query, according to its query_type
+
+        Codepoint and character queries are answered from the description
+        table, without the word index.
+        """
+        kind = query_type(query)
+        if kind == 'CODEPOINT':
+            with self.metrics.stage('lookup'):
+                return self.from_codes(self.codepoint_codes(query))
+        elif kind == 'CHARACTERS':
+            with self.metrics.stage('lookup'):
+                known = self.descriptions()
+                return self.from_codes([code for code in literal_codes(query)
+                                        if code in known])
+        with self.metrics.stage('lookup'):
+            plan = self.plan(query)
+        with self.metrics.stage('intersect'):
+            return plan.execute()
+
+    def codepoint_codes(self, query):
+        """return sorted indexed codepoints in the ranges of query"""
+        table = self.descriptions().codes
+        codes = set()
+        for first, last in parse_codepoints(query):
+            lo = bisect.bisect_left(table, first)
+            hi = bisect.bisect_right(table, last, lo)
+            codes.update(table[lo:hi])
+        return sorted(codes)
+
+    def query_cost(self, query, size=PAGE_SIZE):
+        """estimate the work of find_page(query, size): postings entries read
+
+        With size None, estimate the work of search(query), which computes
+        the whole result.
+
+        Meant to be cheap: nothing is intersected, patterns are not
+        expanded and no table is built. Cached results cost 0, codepoint
+        ranges their span, an upper bound of the indexed chars in them,
+        and * or ~ patterns the number of index words, since expanding one
+        walks the vocabulary. Pages computed lazily cost what page_cost
+        estimates; other queries are evaluated whole, reading all the
+        postings of their terms.
+        """
+        if query_key(query) in self.cache:
+            return 0
+        kind = query_type(query)
+        if kind == 'CODEPOINT':
+            return sum(last - first + 1
+                       for first, last in parse_codepoints(query))
+        elif kind == 'CHARACTERS':
+            return len(query)
+        if PREFIX_MARK in query or FUZZY_MARK in query:
+            return len(self.index)
+        plan = self.plan(query)  # without patterns: parsing and lookups
+        cost = self.page_cost(plan, sys.maxsize if size is None else size)
+        if cost is None:
+            cost = sum(plan.estimates.values())
+        return cost
+
+    def page_cost(self, plan, size):
+        """estimate postings entries lazy_page reads, or None if not lazy"""
+        return None
+
+    def search_many(self, queries):
+        """return dict key -> whole result for a dict key -> query
+
+        The plans not answered by the cache share pattern expansions and
+        one memo, see QueryPlan.
+        """
+        results = {}
+        plans = []
+        expansions = {}
+        for key, query in queries.items():
+            result = self.cache.get(key)
+            if result is not None:
+                results[key] = result
+            elif query_type(query) == 'NAME':
+                with self.metrics.stage('lookup'):
+                    plans.append((key, self.plan(query, expansions)))
+            else:
+                results[key] = self.evaluate(query)
+                self.cache.put(key, results[key])
+        shared = Counter(term for _, plan in plans for term in set(plan.terms))
+        memo = {}
+        for key, plan in plans:
+            with self.metrics.stage('intersect'):
+                results[key] = plan.execute(memo, shared)
+            self.cache.put(key, results[key])
+        return results
+
+    def query_result(self, result, start=0, stop=None):
         stop = sys.maxsize if stop is None else stop
-        result_sets = []
-        for word in tokenize(query):
-            chars = self.index.get(word)
-            if chars is None:  # shorcut: no such word
-                result_sets = []
+        if not result:
+            return QueryResult(0, ())
+        with self.metrics.stage('sort'):
+            items = self.select(result, start, stop)
+        return QueryResult(len(result), self.to_chars(items))
+
+    def find_chars(self, query, start=0, stop=None):
+        return self.query_result(self.search(query), start, stop)
+
+    def find_many(self, queries, start=0, stop=None, batch_size=BATCH_SIZE):
+        """yield (query, QueryResult) for each of queries, in order
+
+        Queries are read and planned batch_size at a time: within a batch,
+        repeated queries are evaluated once and terms common to several
+        queries are intersected once::
+
+            >>> index = UnicodeNameIndex(sample_chars)
+            >>> for query, result in index.find_many(['sign', 'euro sign',
+            ...                                       'Sign', 'latin a']):
+            ...     print(query, result.count)
+            sign 3
+            euro sign 2
+            Sign 3
+            latin a 2
+        """
+        queries = iter(queries)
+        while True:
+            batch = list(itertools.islice(queries, batch_size))
+            if not batch:
                 break
-            result_sets.append(chars)
+            with self.metrics.stage('tokenize'):
+                keys = [query_key(query) for query in batch]
+            results = self.search_many(dict(zip(keys, batch)))
+            for query, key in zip(batch, keys):
+                yield query, self.query_result(results[key], start, stop)
 
-        if not result_sets:
-            return QueryResult(0, ())
+    def find_page(self, query, cursor=None, size=PAGE_SIZE):
+        """return QueryPage with up to size chars after cursor
 
-        result = functools.reduce(set.intersection, result_sets)
-        result = sorted(result)  # must sort to support start, stop
-        result_iter = itertools.islice(result, start, stop)
-        return QueryResult(len(result),
-                           (char for char in result_iter))
+        The page cursor is None on the last page; otherwise pass it back
+        to get the next page. Cursors depend only on the query and the
+        last char returned, so any handler or index instance can use them.
+        """
+        first_code = decode_cursor(cursor)
+        with self.metrics.stage('tokenize'):
+            key = query_key(query)
+        result = self.cache.get(key)
+        if result is None and query_type(query) != 'NAME':
+            result = self.evaluate(query)
+            self.cache.put(key, result)
+        elif result is None:
+            with self.metrics.stage('lookup'):
+                plan = self.plan(query)
+            # pages are lazy iterators: timed stages consume them
+            with self.metrics.stage('intersect'):
+                items = self.lazy_page(plan, first_code, size + 1)
+                if items is None:
+                    result = plan.execute()
+                else:
+                    items = list(items)
+            if items is None:
+                self.cache.put(key, result)
+        if result is not None:
+            with self.metrics.stage('sort'):
+                items = list(self.result_page(result, first_code, size + 1))
+        items = list(self.to_chars(items))
+        if len(items) > size:
+            del items[size:]
+            return QueryPage(items, encode_cursor(items[-1]))
+        return QueryPage(items, None)
+
+    def empty(self):
+        return frozenset()
+
+    def from_codes(self, codes):
+        """return result of sorted codepoints, as plan.execute() would"""
+        return frozenset(map(chr, codes))
+
+    def union(self, postings):
+        if len(postings) == 1:
+            return postings[0]
+        return set().union(*postings)
+
+    def intersection(self, a, b):
+        return a & b
+
+    def difference(self, a, b):
+        return a - b
+
+    def select(self, result, start, stop):
+        if stop < len(result):  # partial sort: O(n log stop)
+            return heapq.nsmallest(stop, result)[start:]
+        return sorted(result)[start:]  # must sort to support start, stop
+
+    def lazy_page(self, plan, first_code, size):
+        """return page items without running the whole plan, or None"""
+        return None
+
+    def result_page(self, result, first_code, size):
+        first_char = chr(first_code)
+        return heapq.nsmallest(size, (char for char in result
+                                      if char >= first_char))
+
+    def to_chars(self, items):
+        return (char for char in items)
 
     def describe(self, char):
         code_str = 'U+{:04X}'.format(ord(char))
@@ -183,12 +1447,26 @@ class UnicodeNameIndex:
         for char in chars:
             yield self.describe(char)
 
+    def describe_bytes(self, char):
+        """return description line of char as UTF-8 bytes ending with CRLF"""
+        try:
+            return self.descriptions().line(ord(char))
+        except KeyError:  # not in the index: format it
+            return description_line(char)
+
     def describe_str(self, char):
-        return '{:7}\t{}\t{}'.format(*self.describe(char))
+        return self.describe_bytes(char)[:-len(CRLF)].decode('utf-8')
+
+    def describe_lines(self, chars):
+        """yield description lines of indexed chars, in order, as bytes"""
+        return self.descriptions().lines(map(ord, chars))
+
+    def find_description_bytes(self, query, start=0, stop=None):
+        return self.describe_lines(self.find_chars(query, start, stop).items)
 
     def find_description_strs(self, query, start=0, stop=None):
-        for char in self.find_chars(query, start, stop).items:
-            yield self.describe_str(char)
+        for line in self.find_description_bytes(query, start, stop):
+            yield line[:-len(CRLF)].decode('utf-8')
 
     @staticmethod  # not an instance method due to concurrency
     def status(query, counter):
@@ -201,8 +1479,282 @@ class UnicodeNameIndex:
         return '{} for {!r}'.format(msg, query)
 
 
-def main(*args):
-    index = UnicodeNameIndex()
+class CompactNameIndex(UnicodeNameIndex):
+    """UnicodeNameIndex with postings stored as sorted array('I') of codepoints
+
+    Same queries, same QueryResult contract, a fraction of the memory.
+    The index is persisted in the binary format of ``charfinder_store``
+    and opened with ``mmap``. When the file was written for another
+    ``unicodedata.unidata_version``, only newly named chars are indexed
+    and merged into it::
+
+        >>> index = CompactNameIndex(sample_chars)
+        >>> index.index['SIGN']
+        array('I', [36, 8352, 8364])
+        >>> index.find_chars('sign euro').count
+        2
+    """
+
+    index_name = COMPACT_INDEX_NAME
+    bitmap_threshold = BITMAP_THRESHOLD
+
+    def load(self, chars=None):
+        self.index = None
+        if chars is None:
+            self.index = self.open_mapped()
+            if (self.index is not None and
+                    self.unidata_version != unicodedata.unidata_version):
+                self.update_index()
+        if self.index is None:
+            self.build_index(chars)
+        if (not isinstance(self.index, MappedIndex) and
+                len(self.index) > MINIMUM_SAVE_LEN):
+            try:
+                self.save()
+            except OSError as exc:
+                warnings.warn('Could not save {!r}: {}'
+                              .format(self.index_name, exc))
+            else:  # drop the private copy, share the page cache
+                self.index = self.open_mapped() or self.index
+
+    def open_mapped(self):
+        """return MappedIndex from the index file, or None if unusable"""
+        try:
+            index = MappedIndex(self.index_name)
+        except (OSError, IndexFormatError):
+            return None
+        self.unidata_version = index.unidata_version
+        return index
+
+    def save(self):
+        write_index(self.index_name, self.index, self.unidata_version,
+                    self.descriptions(), self.ranks().order)
+
+    def indexed_codes(self):
+        return sorted(set(itertools.chain.from_iterable(self.index.values())))
+
+    def merge_postings(self, delta):
+        previous = self.descriptions()
+        index = dict(self.index.items())  # untouched postings stay mapped
+        for word, codes in delta.items():  # old and new codes are disjoint
+            merged = array('I', heapq.merge(index.get(word, ()), codes))
+            index[word] = compact_postings(merged, self.bitmap_threshold)
+        new_codes = sorted(set(itertools.chain.from_iterable(delta.values())))
+        self.index = index
+        self._descriptions = merge_descriptions(previous, new_codes)
+
+    def build_index(self, chars=None):
+        self.unidata_version = unicodedata.unidata_version
+        index = {}
+        for _, partial in self.iter_postings(chars):
+            for word, codes in partial.items():  # partials in code order
+                index.setdefault(word, array('I')).extend(codes)
+        self.index = {word: compact_postings(codes, self.bitmap_threshold)
+                      for word, codes in index.items()}
+
+    def empty(self):
+        return array('I')
+
+    def from_codes(self, codes):
+        return array('I', codes)
+
+    def union(self, postings):
+        if not any(isinstance(seq, BitmapPostings) for seq in postings):
+            return union_sorted(postings)
+        bitmaps = [seq if isinstance(seq, BitmapPostings)
+                   else BitmapPostings.from_codes(seq) for seq in postings]
+        return functools.reduce(operator.or_, bitmaps)
+
+    def intersection(self, a, b):
+        if isinstance(a, BitmapPostings):
+            a, b = b, a
+        if isinstance(a, BitmapPostings):  # both bitmaps
+            return a & b
+        if isinstance(b, BitmapPostings):
+            return array('I', (code for code in a if code in b))
+        return intersect_sorted(a, b)
+
+    def difference(self, a, b):
+        if isinstance(a, BitmapPostings):
+            if not isinstance(b, BitmapPostings):
+                b = BitmapPostings.from_codes(b)
+            return a - b
+        if isinstance(b, BitmapPostings):
+            return array('I', (code for code in a if code not in b))
+        return difference_sorted(a, b)
+
+    def select(self, result, start, stop):
+        return itertools.islice(result, start, stop)  # already sorted
+
+    def lazy_page(self, plan, first_code, size):
+        postings = plan.conjunction()
+        if postings is None:
+            return None
+        if not postings:  # nothing to intersect: the result is empty
+            return iter(())
+        # only the first size common codepoints are visited
+        return itertools.islice(iter_intersection(postings, first_code), size)
+
+    def page_cost(self, plan, size):
+        """entries of the shortest postings visited to find size results
+
+        A single word is sliced in place: it costs 0. Otherwise the share
+        of the shortest postings also in all the others is estimated from
+        COST_SAMPLE entries spread over it; when it is a bitmap, so are
+        all the others, and the words are taken to occur independently.
+        """
+        postings = plan.conjunction()
+        if postings is None:
+            return None
+        if len(postings) < 2:
+            return 0
+        driver, *others = sorted(postings, key=len)
+        if not len(driver):
+            return 0
+        if isinstance(driver, BitmapPostings):
+            chars = len(self.descriptions().codes)
+            density = math.prod(len(seq) / chars for seq in others)
+        else:
+            sample = driver[::max(len(driver) // COST_SAMPLE, 1)]
+            found = sum(all(contains(seq, code) for seq in others)
+                        for code in sample)
+            density = found / len(sample)
+        if not density:  # none found: all of the driver may be visited
+            return len(driver)
+        return int(min(len(driver), size / density))
+
+    def result_page(self, result, first_code, size):
+        return itertools.islice(iter_from(result, first_code), size)
+
+    def to_chars(self, items):
+        return map(chr, items)
+
+
+class IndexNotReady(RuntimeError):
+    """the index is still loading in the background"""
+
+
+class LazyIndex:
+    """index loaded in a background thread, so servers can start at once
+
+    Attribute access is delegated to the loaded index; until it is ready,
+    each access waits at most ``timeout`` seconds, then raises
+    IndexNotReady. ``ready`` is meant for health checks. An exception
+    raised by the loader is re-raised on access.
+    """
+
+    status = staticmethod(UnicodeNameIndex.status)  # needs no index
+
+    def __init__(self, index_class=CompactNameIndex, timeout=READY_TIMEOUT,
+                 **kwargs):
+        self.timeout = timeout
+        self._index = None
+        self._error = None
+        self._loaded = threading.Event()
+        self.load_time = None
+        self._loader = threading.Thread(target=self._load, daemon=True,
+                                        args=(index_class, kwargs),
+                                        name='charfinder-index-loader')
+        self._loader.start()
+
+    def _load(self, index_class, kwargs):
+        t0 = time.perf_counter()
+        try:
+            self._index = index_class(**kwargs)
+        except Exception as exc:
+            self._error = exc
+        finally:
+            self.load_time = time.perf_counter() - t0
+            self._loaded.set()
+
+    @property
+    def ready(self):
+        return self._loaded.is_set() and self._error is None
+
+    def wait_ready(self, timeout=None):
+        """block up to timeout seconds; return True if the index is ready"""
+        self._loaded.wait(timeout)
+        return self.ready
+
+    def wait(self, timeout=None):
+        """return the loaded index, waiting up to timeout seconds"""
+        if not self._loaded.wait(timeout):
+            raise IndexNotReady('index still loading')
+        if self._error is not None:
+            raise self._error
+        return self._index
+
+    def __getattr__(self, name):
+        return getattr(self.wait(self.timeout), name)
+
+
+class QueryRunner:
+    """run server queries inline or in an executor, by estimated cost
+
+    A query whose cost is at most ``inline_cost`` runs on the event loop
+    thread: handing it to an executor would take longer than answering
+    it. Costlier queries run in ``executor``, the loop's default thread
+    pool if None. Unless ``run`` is given the cost, it is estimated by
+    ``index.query_cost`` for a page of ``page_size`` results, plus
+    ROW_COST for each of them. Each query is recorded as a QueryTiming:
+    ``wall`` seconds until answered, ``blocking`` seconds of those spent
+    on the event loop thread, and observed by ``metrics`` as the query
+    and loop_blocked stages. Meant to be used from one event loop.
+    """
+
+    def __init__(self, index, inline_cost=INLINE_COST, executor=None,
+                 log_len=QUERY_LOG_LEN, metrics=None, page_size=PAGE_SIZE):
+        self.index = index
+        self.inline_cost = inline_cost
+        self.page_size = page_size
+        self.executor = executor
+        self.metrics = NO_METRICS if metrics is None else metrics
+        self.timings = deque(maxlen=log_len)
+        self.count = self.offloaded = 0
+        self.wall = self.blocking = self.max_blocking = 0.0
+
+    async def run(self, loop, query, function, *args, cost=None):
+        """return function(*args), which answers query at about cost"""
+        t0 = time.perf_counter()
+        if cost is None:
+            cost = (self.index.query_cost(query, self.page_size) +
+                    self.page_size * ROW_COST)
+        offloaded = cost > self.inline_cost
+        if offloaded:
+            future = loop.run_in_executor(self.executor, function, *args)
+            blocking = time.perf_counter() - t0
+            result = await future
+        else:
+            result = function(*args)
+            blocking = time.perf_counter() - t0
+        self.record(QueryTiming(query, cost, offloaded,
+                                time.perf_counter() - t0, blocking))
+        return result
+
+    def record(self, timing):
+        self.timings.append(timing)
+        self.count += 1
+        self.offloaded += timing.offloaded
+        self.wall += timing.wall
+        self.blocking += timing.blocking
+        self.max_blocking = max(self.max_blocking, timing.blocking)
+        self.metrics.observe('query', timing.wall)
+        self.metrics.observe('loop_blocked', timing.blocking)
+        if timing.offloaded:
+            self.metrics.count('offloaded_queries')
+
+    def report(self):
+        if not self.count:
+            return 'No queries'
+        return ('{} queries, {} offloaded; mean wall {:.2f} ms, loop blocked '
+                '{:.2f} ms mean, {:.2f} ms max').format(
+            self.count, self.offloaded, self.wall / self.count * 1000,
+            self.blocking / self.count * 1000, self.max_blocking * 1000)
+
+
+def main(*args, workers=None, index=None):
+    if index is None:
+        index = CompactNameIndex(workers=workers)
     query = ' '.join(args)
     n = 0
     for n, line in enumerate(index.find_description_strs(query), 1):
@@ -210,7 +1762,28 @@ def main(*args):
     print('({})'.format(index.status(query, n)))
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        main(*sys.argv[1:])
-    else:
-        print('Usage: {} word1 [word2]...'.format(sys.argv[0]))
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Find Unicode characters by words in their names.')
+    parser.add_argument('words', nargs='+', metavar='word')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='processes used if the index must be built '
+                             '(default: build serially)')
+    parser.add_argument('--aliases', metavar='FILE', nargs='?',
+                        const=ALIASES_NAME, default=None,
+                        help='also index aliases from a NameAliases.txt file '
+                             '(default file: %(const)s)')
+    parser.add_argument('--folded', action='store_true',
+                        help='also index casefolded, accent-stripped chars')
+    parser.add_argument('--source-report', action='store_true',
+                        help='print index size and build time per source')
+    args = parser.parse_args()
+    sources = list(DEFAULT_SOURCES)
+    if args.aliases:
+        sources.append(AliasNames(args.aliases))
+    if args.folded:
+        sources.append(FoldedNames())
+    index = CompactNameIndex(workers=args.workers, sources=sources)
+    main(*args.words, index=index)
+    if args.source_report:
+        index.source_report()
\ No newline at end of file
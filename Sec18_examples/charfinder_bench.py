@@ -0,0 +1,494 @@
+"""Benchmarks for the charfinder index representations.
+
+Run one or more benchmarks by name::
+
+    $ python3 charfinder_bench.py index
+"""
+
+import gc
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import http.client
+import subprocess
+import tracemalloc
+from concurrent import futures
+from urllib.parse import quote_plus
+
+from charfinder import (UnicodeNameIndex, CompactNameIndex, DESCRIPTION_FMT,
+                        DEFAULT_SOURCES, AliasNames, FoldedNames, INLINE_COST)
+from charfinder_store import write_index
+from charfinder_shards import ShardedIndex
+import charfinder_client
+
+OLD_UNIDATA_VERSION = '0.0.0'
+OLD_LAST_CODEPOINT = 0x1F900  # pretend later chars were not named yet
+
+QUERY_MIX = ['chess black', 'sun', 'arrow', 'cjk', 'latin small letter',
+             'letter', 'sign', 'cat face', 'digit', 'cjk ideograph unified',
+             'greek capital', 'box drawings light', 'jabberwocky']
+
+BATCH_PREFIXES = ['latin small letter', 'latin capital letter', 'greek small',
+                  'mathematical bold', 'cjk -compatibility', 'circled',
+                  'black|white', 'sign', 'let*', 'arrow~']
+BATCH_WORD_STEP = 60  # every 60th index word, about 400 words
+
+REPEAT = 20
+
+TCP_HOST, TCP_PORT = '127.0.0.1', 2424
+TCP_CONNECTIONS = 8  # per client process
+TCP_DEPTH = 8
+TCP_QUERIES = 4000  # per client process
+HTTP_HOST, HTTP_PORT = '127.0.0.1', 8989
+
+
+def measure_build(cls):
+    """return (index, seconds to load, bytes held) for a fresh instance"""
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    index = cls()
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, elapsed, held
+
+
+def measure_queries(index, queries, repeat=REPEAT):
+    """return mean seconds per query, consuming every result"""
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            result = index.find_chars(query)
+            for _ in result.items:
+                pass
+    return (time.perf_counter() - t0) / (repeat * len(queries))
+
+
+def bench_index(args):
+    """memory and latency of the set-based vs. array-based index"""
+    # tracemalloc sees the Python heap only; CompactNameIndex reads its
+    # postings from a memory-mapped file: mapped MB is the file size, and
+    # rss MB what the process grew by while loading and querying, mapped
+    # pages included (Linux only). The array index goes first, so memory
+    # the allocator keeps after the set index is not counted for it.
+    print('{:18} {:>9} {:>10} {:>10} {:>10} {:>12}'.format(
+          'index', 'load s', 'heap MB', 'mapped MB', 'rss MB', 'query ms'))
+    for cls in (CompactNameIndex, UnicodeNameIndex):
+        rss_before = proc_kib(os.getpid(), 'VmRSS')
+        index, load_time, held = measure_build(cls)
+        query_time = measure_queries(index, QUERY_MIX, args.repeat)
+        rss_after = proc_kib(os.getpid(), 'VmRSS')
+        mapped = (os.path.getsize(index.index_name)
+                  if isinstance(index, CompactNameIndex) else 0)
+        grown = ('{:10.1f}'.format((rss_after - rss_before) / 2**10)
+                 if rss_before is not None else '{:>10}'.format('-'))
+        print('{:18} {:9.3f} {:10.1f} {:10.1f} {} {:12.3f}'.format(
+              cls.__name__, load_time, held / 2**20, mapped / 2**20, grown,
+              query_time * 1000))
+        del index
+        gc.collect()
+
+
+def temp_index_class(tmp_dir, name='charfinder_index.bin'):
+    """CompactNameIndex subclass saving its index in tmp_dir"""
+    return type('BenchIndex', (CompactNameIndex,),
+                {'index_name': os.path.join(tmp_dir, name)})
+
+
+def bench_build(args):
+    """cold build time, serial vs. process pool"""
+    workers = args.workers or os.cpu_count()
+    for count in (None, workers):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            t0 = time.perf_counter()
+            index = temp_index_class(tmp_dir)(workers=count)
+            elapsed = time.perf_counter() - t0
+        print('{:>8} worker(s): {:7.3f}s, {} words'.format(
+              count or 1, elapsed, len(index.index)))
+        del index
+
+
+def bench_sources(args):
+    """index size and build time of each name source"""
+    sources = list(DEFAULT_SOURCES) + [FoldedNames()]
+    if args.aliases:
+        sources.append(AliasNames(args.aliases))
+    else:
+        print('(no --aliases file given: alias source skipped)')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = temp_index_class(tmp_dir)(workers=args.workers,
+                                          sources=sources)
+        index.source_report()
+        del index
+
+
+def bench_page(args):
+    """first 20 results of broad queries: find_chars slice vs. find_page"""
+    queries = ['cjk', 'cjk unified ideograph', 'letter', 'latin letter small']
+    print('{:18} {:>14} {:>14}'.format('index', 'slice ms', 'page ms'))
+    for cls in (UnicodeNameIndex, CompactNameIndex):
+        index = cls()
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for query in queries:
+                list(index.find_chars(query, 0, 20).items)
+        sliced = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for query in queries:
+                index.find_page(query, size=20)
+        paged = time.perf_counter() - t0
+        runs = args.repeat * len(queries)
+        print('{:18} {:14.3f} {:14.3f}'.format(
+              cls.__name__, sliced / runs * 1000, paged / runs * 1000))
+
+
+def bench_describe(args):
+    """describing large results: formatting per row vs. precomputed table"""
+    index = CompactNameIndex()
+    index.descriptions()  # built or mapped once, outside the timing
+    print('{:12} {:>8} {:>14} {:>14}'.format(
+          'query', 'rows', 'format ms', 'table ms'))
+    for query in ['letter', 'sign', 'cjk']:
+        chars = list(index.find_chars(query).items)
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for char in chars:
+                line = DESCRIPTION_FMT.format(*index.describe(char))
+                (line + '\r\n').encode()
+        formatted = (time.perf_counter() - t0) / args.repeat
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for _ in index.describe_lines(chars):
+                pass
+        table = (time.perf_counter() - t0) / args.repeat
+        print('{:12} {:8} {:14.3f} {:14.3f}'.format(
+              query, len(chars), formatted * 1000, table * 1000))
+
+
+def bench_update(args):
+    """startup after a Unicode upgrade: incremental update vs. full build"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_class = temp_index_class(tmp_dir)
+        path = index_class.index_name
+        old = index_class([chr(code) for code in range(OLD_LAST_CODEPOINT)])
+        write_index(path, old.index, OLD_UNIDATA_VERSION, old.descriptions())
+        t0 = time.perf_counter()
+        index_class()
+        updated = time.perf_counter() - t0
+        os.remove(path)
+        t0 = time.perf_counter()
+        index_class()
+        built = time.perf_counter() - t0
+    print('incremental update: {:7.3f}s'.format(updated))
+    print('full build:         {:7.3f}s'.format(built))
+
+
+def bench_bitmap(args):
+    """frequent-word queries: sorted arrays only vs. arrays and bitmaps"""
+    queries = ['cjk unified ideograph', 'letter small', 'letter -latin',
+               'cjk', 'sign | symbol']
+    print('{:24} {:>12} {:>12}'.format('query', 'arrays ms', 'bitmaps ms'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        indexes = []
+        for threshold in (None, CompactNameIndex.bitmap_threshold):
+            path = os.path.join(tmp_dir, 'index_{}.bin'.format(threshold))
+            index_class = type('BenchIndex', (CompactNameIndex,),
+                               {'index_name': path,
+                                'bitmap_threshold': threshold})
+            indexes.append(index_class())
+        for query in queries:
+            times = []
+            for index in indexes:
+                t0 = time.perf_counter()
+                for _ in range(args.repeat):
+                    index.cache.clear()  # time the query, not the cache
+                    for _ in index.find_chars(query).items:
+                        pass
+                times.append((time.perf_counter() - t0) / args.repeat)
+            print('{:24} {:12.3f} {:12.3f}'.format(
+                  query, times[0] * 1000, times[1] * 1000))
+
+
+def batch_queries(index):
+    """shuffled queries combining common prefixes with many index words"""
+    words = index.vocabulary().words[::BATCH_WORD_STEP]
+    queries = ['{} {}'.format(prefix, word)
+               for prefix in BATCH_PREFIXES for word in words]
+    queries.extend(QUERY_MIX * 50)  # some repeated queries, too
+    random.Random(0).shuffle(queries)
+    return queries
+
+
+def bench_many(args):
+    """resolving a batch of queries: find_chars loop vs. find_many"""
+    print('{:18} {:>8} {:>10} {:>12}'.format(
+          'index', 'queries', 'loop s', 'find_many s'))
+    for cls in (UnicodeNameIndex, CompactNameIndex):
+        index = cls()
+        queries = batch_queries(index)
+        index.cache.clear()
+        t0 = time.perf_counter()
+        for query in queries:
+            for _ in index.find_chars(query).items:
+                pass
+        looped = time.perf_counter() - t0
+        index.cache.clear()
+        t0 = time.perf_counter()
+        for _, result in index.find_many(queries):
+            for _ in result.items:
+                pass
+        batched = time.perf_counter() - t0
+        print('{:18} {:8} {:10.3f} {:12.3f}'.format(
+              cls.__name__, len(queries), looped, batched))
+
+
+def measure_throughput(index, queries, repeat, stop):
+    """return queries per second of find_chars(query, 0, stop)"""
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            for _ in index.find_chars(query, 0, stop).items:
+                pass
+    return repeat * len(queries) / (time.perf_counter() - t0)
+
+
+def bench_shards(args):
+    """throughput of the query mix: one process vs. N shard processes"""
+    cores = os.cpu_count()
+    counts = sorted({1, 2, cores, args.workers or cores})
+    print('{} CPU(s); caches off, so every query is evaluated'.format(cores))
+    print('{:18} {:>12} {:>12}'.format('index', 'page q/s', 'full q/s'))
+    index = CompactNameIndex(cache_max_chars=0)
+    print('{:18} {:12.1f} {:12.1f}'.format(
+          'in process', measure_throughput(index, QUERY_MIX, args.repeat, 20),
+          measure_throughput(index, QUERY_MIX, args.repeat, None)))
+    del index
+    for count in counts:
+        with ShardedIndex(count, cache_max_chars=0) as index:
+            print('{:18} {:12.1f} {:12.1f}'.format(
+                  '{} shard(s)'.format(count),
+                  measure_throughput(index, QUERY_MIX, args.repeat, 20),
+                  measure_throughput(index, QUERY_MIX, args.repeat, None)))
+
+
+def bench_workers(args):
+    """tcp_charfinder.py throughput with 1 to N SO_REUSEPORT workers"""
+    cores = os.cpu_count()
+    counts = sorted({1, 2, cores, args.workers or cores})
+    clients = max(1, cores // 2)  # client processes generating the load
+    print('{} CPU(s), {} client process(es) x {} connections x depth {}'
+          .format(cores, clients, TCP_CONNECTIONS, TCP_DEPTH))
+    print('{:>8} {:>12}'.format('workers', 'queries/s'))
+    for count in counts:
+        server = subprocess.Popen(
+            [sys.executable, 'tcp_charfinder.py', TCP_HOST, str(TCP_PORT),
+             '--workers', str(count), '--rate', '0'], stdout=subprocess.DEVNULL)
+        try:
+            if not charfinder_client.wait_ready(TCP_HOST, TCP_PORT, 60):
+                print('{:>8} server not ready'.format(count))
+                continue
+            time.sleep(0.5)  # let every worker start listening
+            with futures.ProcessPoolExecutor(clients) as executor:
+                jobs = [executor.submit(charfinder_client.run_load, TCP_HOST,
+                                        TCP_PORT, TCP_CONNECTIONS, TCP_DEPTH,
+                                        TCP_QUERIES)
+                        for _ in range(clients)]
+                results = [job.result() for job in jobs]
+            elapsed = max(seconds for seconds, _ in results)
+            answered = sum(count for _, count in results)
+            print('{:>8} {:12.1f}'.format(count, answered / elapsed))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_offload(args):
+    """tcp_charfinder.py with queries inline, offloaded by cost, or all offloaded"""
+    settings = [('all inline', sys.maxsize), ('by cost', INLINE_COST),
+                ('all offloaded', -1)]
+    print('{:14} {:>12} {:>10} {:>10}'.format('queries', 'queries/s',
+                                              'median ms', 'max ms'))
+    for label, inline_cost in settings:
+        server = subprocess.Popen(
+            [sys.executable, 'tcp_charfinder.py', TCP_HOST, str(TCP_PORT),
+             '--inline-cost', str(inline_cost), '--rate', '0'],
+            stdout=subprocess.DEVNULL)
+        try:
+            if not charfinder_client.wait_ready(TCP_HOST, TCP_PORT, 60):
+                print('{:14} server not ready'.format(label))
+                continue
+            result = asyncio.run(charfinder_client.load(
+                TCP_HOST, TCP_PORT, TCP_CONNECTIONS, TCP_DEPTH, TCP_QUERIES))
+            elapsed, latencies = result.elapsed, sorted(result.latencies)
+            print('{:14} {:12.1f} {:10.2f} {:10.2f}'.format(
+                  label, len(latencies) / elapsed,
+                  latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def proc_kib(pid, field):
+    """return a size field of /proc/pid/status, like VmRSS, in KiB, or None"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:  # not Linux
+        return None
+
+
+def peak_rss(pid):
+    """return peak resident set size of process pid in KiB, or None"""
+    return proc_kib(pid, 'VmHWM')
+
+
+def http_ready(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(HTTP_HOST, HTTP_PORT, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def http_requests(paths, keep_alive=True, etags=None):
+    """GET each of paths; return (seconds, body bytes received)
+
+    With etags, a dict path -> ETag, requests are conditional.
+    """
+    received = 0
+    conn = None
+    t0 = time.perf_counter()
+    for path in paths:
+        if conn is None or not keep_alive:
+            if conn is not None:
+                conn.close()
+            conn = http.client.HTTPConnection(HTTP_HOST, HTTP_PORT)
+        headers = {} if etags is None else {'If-None-Match': etags[path]}
+        conn.request('GET', path, headers=headers)
+        received += len(conn.getresponse().read())
+    conn.close()
+    return time.perf_counter() - t0, received
+
+
+def bench_api(args):
+    """http_charfinder.py HTML pages vs /api/find JSON, keep-alive, ETags"""
+    queries = [quote_plus(query) for query in QUERY_MIX]
+    html = ['/?query={}'.format(query) for query in queries] * args.repeat
+    api = ['/api/find?query={}'.format(query) for query in queries] * args.repeat
+    server = subprocess.Popen(
+        [sys.executable, 'http_charfinder.py', HTTP_HOST, str(HTTP_PORT)],
+        stdout=subprocess.DEVNULL)
+    try:
+        if not http_ready(60):
+            print('server not ready')
+            return
+        conn = http.client.HTTPConnection(HTTP_HOST, HTTP_PORT)
+        etags = {}
+        for path in set(api):
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            etags[path] = response.getheader('ETag')
+        conn.close()
+        print('{:28} {:>12} {:>12}'.format('requests', 'requests/s', 'KiB'))
+        for label, paths, keep_alive, conditional in [
+                ('HTML, keep-alive', html, True, None),
+                ('JSON, keep-alive', api, True, None),
+                ('JSON, new connections', api, False, None),
+                ('JSON, If-None-Match', api, True, etags)]:
+            elapsed, received = http_requests(paths, keep_alive, conditional)
+            print('{:28} {:12.1f} {:12}'.format(
+                  label, len(paths) / elapsed, received // 1024))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_stream(args):
+    """http_charfinder.py time to first byte and peak RSS of 'cjk' pages"""
+    print('{:>8} {:>10} {:>10} {:>10} {:>14}'.format(
+          'rows', 'TTFB ms', 'total ms', 'KiB', 'server peak KiB'))
+    for size in (100, 1000, 10000):
+        # a fresh server for each size, so its peak RSS is this page's
+        server = subprocess.Popen(
+            [sys.executable, 'http_charfinder.py', HTTP_HOST, str(HTTP_PORT)],
+            stdout=subprocess.DEVNULL)
+        try:
+            if not http_ready(60):
+                print('{:>8} server not ready'.format(size))
+                continue
+            before = peak_rss(server.pid)
+            conn = http.client.HTTPConnection(HTTP_HOST, HTTP_PORT)
+            t0 = time.perf_counter()
+            conn.request('GET', '/?query=cjk&size={}'.format(size))
+            response = conn.getresponse()
+            response.read(1)
+            ttfb = time.perf_counter() - t0
+            body = response.read()
+            elapsed = time.perf_counter() - t0
+            after = peak_rss(server.pid)
+            growth = '-' if after is None else after - before
+            print('{:8} {:10.2f} {:10.2f} {:10} {:>14}'.format(
+                  size, ttfb * 1000, elapsed * 1000, (len(body) + 1) // 1024,
+                  '{} (+{})'.format(after, growth)))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+BENCHMARKS = {
+    'api': bench_api,
+    'bitmap': bench_bitmap,
+    'index': bench_index,
+    'many': bench_many,
+    'offload': bench_offload,
+    'build': bench_build,
+    'describe': bench_describe,
+    'page': bench_page,
+    'shards': bench_shards,
+    'stream': bench_stream,
+    'sources': bench_sources,
+    'workers': bench_workers,
+    'update': bench_update,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS),
+                        metavar='BENCHMARK',
+                        help='one of: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT,
+                        help='times to run each query mix (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='processes for parallel benchmarks, '
+                             'shards for the shards benchmark '
+                             '(default: CPU count)')
+    parser.add_argument('--aliases', metavar='FILE', default=None,
+                        help='NameAliases.txt file for the sources benchmark')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {!r}'.format(name))
+    for name in args.names:
+        print('*** {}: {}'.format(name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,343 @@
+"""Load generator for the charfinder servers: throughput, latency, errors.
+
+Each of ``--connections`` clients replays a query mix, in order and over
+and over, until ``--queries`` answers in total were received. Against
+tcp_charfinder.py each client keeps up to ``--depth`` queries in flight
+on its connection; against http_charfinder.py (``--http``, needs aiohttp)
+each client sends one request at a time over a keep-alive connection::
+
+    $ python3 tcp_charfinder.py &
+    $ python3 charfinder_client.py -c 8 -d 16 -n 20000
+    $ python3 http_charfinder.py &
+    $ python3 charfinder_client.py --http --mix charfinder_queries.txt
+
+When tcp_charfinder.py drains on shutdown, it answers the queries it
+read and closes the connection; clients connect again, to the next server
+on the port, and send the queries left unanswered, up to ``--reconnects``
+times in a row.
+
+A mix file has one query per line; blank lines and lines starting with
+# are skipped. With ``--json`` the report is one JSON object, including
+the options and ``--label``, to compare index representations and server
+modes between runs.
+"""
+
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import Counter, namedtuple
+from urllib.parse import quote_plus
+
+PROMPT = b'?> '
+CRLF = b'\r\n'
+QUERY_MIX = ['chess black', 'sun', 'arrow', 'cjk', 'latin small letter',
+             'letter', 'sign', 'cat face', 'digit', 'cjk ideograph unified',
+             'greek capital', 'box drawings light', 'jabberwocky',
+             'ches* bishopp~', 'U+2650..U+265F']
+# tcp_charfinder answers with these when it cannot answer the query
+RETRY_ANSWERS = (b'try again', b'Query too long.')
+HTTP_PATH = '/api/find'
+TIMEOUT = 30.0  # seconds to wait for one answer
+RECONNECTS = 3  # connections in a row closed by the server, before giving up
+PERCENTILES = (50, 95, 99)
+
+LoadResult = namedtuple('LoadResult', 'elapsed latencies errors reconnects')
+
+
+def read_mix(path):
+    """return the queries of a mix file, skipping blanks and # comments"""
+    with open(path, encoding='utf-8') as mix:
+        queries = [line.strip() for line in mix]
+    return [query for query in queries if query and not query.startswith('#')]
+
+
+def percentile(latencies, percent):
+    """nearest rank percentile of sorted latencies
+
+        >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+        10
+        >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+        5
+    """
+    rank = math.ceil(percent / 100 * len(latencies))
+    return latencies[max(rank, 1) - 1]
+
+
+async def run_client(host, port, queries, depth, counter, errors=None,
+                     timeout=TIMEOUT, reconnects=None, max_reconnects=RECONNECTS):
+    """send queries pipelined, depth at a time; count answers in counter
+
+    Every answer ends with a prompt, so answers are counted by prompts.
+    Answers asking to retry, and failures ending the connection, are
+    counted by kind in errors. A connection the server closes between
+    answers is opened again, counted in reconnects, and the queries it
+    left unanswered are sent again. The client gives up after
+    max_reconnects connections in a row closed without any answer.
+    Return the answer latencies in seconds.
+    """
+    errors = Counter() if errors is None else errors
+    reconnects = [0] if reconnects is None else reconnects
+    latencies = []
+    queries = iter(queries)
+    unanswered = []
+    in_a_row = 0  # reconnects since the last connection that got answers
+    while True:
+        answered = len(latencies)
+        unanswered = await run_connection(
+            host, port, itertools.chain(unanswered, queries), depth, counter,
+            errors, latencies, timeout)
+        if unanswered is None:
+            break
+        if len(latencies) > answered:  # this connection got answers
+            in_a_row = 0
+        if in_a_row == max_reconnects:
+            errors['closed by server'] += 1
+            break
+        in_a_row += 1
+        reconnects[0] += 1
+    return latencies
+
+
+async def run_connection(host, port, queries, depth, counter, errors,
+                         latencies, timeout):
+    """run_client over one connection
+
+    Return the queries left unanswered if the server closed the connection
+    between answers, else None.
+    """
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError) as exc:
+        errors['connect ' + type(exc).__name__] += 1
+        return None
+    sent = asyncio.Queue(depth)  # (time sent, query); bounds the queries in flight
+    failed = False
+    unanswered = None  # a list once the server closed between answers
+
+    async def receive():
+        nonlocal failed, unanswered
+        while True:
+            item = await sent.get()
+            if item is None:
+                break
+            started, query = item
+            if failed:  # just let the sender go on to its end
+                if unanswered is not None:
+                    unanswered.append(query)
+                continue
+            try:
+                answer = await asyncio.wait_for(reader.readuntil(PROMPT),
+                                                timeout)
+            except asyncio.IncompleteReadError as exc:
+                failed = True
+                if exc.partial:  # cut off in the middle of an answer
+                    errors['closed by server'] += 1
+                else:
+                    unanswered = [query]
+                continue
+            except (OSError, asyncio.TimeoutError) as exc:
+                errors[type(exc).__name__] += 1
+                failed = True
+                continue
+            latencies.append(time.perf_counter() - started)
+            counter[0] += 1
+            if any(text in answer for text in RETRY_ANSWERS):
+                errors['retry'] += 1
+
+    receiving = None
+    try:
+        # the greeting prompt; a server over its connection cap closes instead
+        await asyncio.wait_for(reader.readuntil(PROMPT), timeout)
+        receiving = asyncio.create_task(receive())
+        for query in queries:
+            await sent.put((time.perf_counter(), query))
+            writer.write(query.encode() + CRLF)
+            await writer.drain()
+            if failed:
+                break
+        await sent.put(None)
+        await receiving
+    except asyncio.IncompleteReadError:
+        errors['closed by server'] += 1
+    except (OSError, asyncio.TimeoutError) as exc:
+        if unanswered is None:  # else a write after the server closed
+            errors[type(exc).__name__] += 1
+    finally:
+        if receiving is not None:
+            receiving.cancel()
+        writer.close()
+    while unanswered is not None and not sent.empty():
+        item = sent.get_nowait()
+        if item is not None:
+            unanswered.append(item[1])
+    return unanswered
+
+
+async def run_http_client(session, base_url, queries, counter, errors,
+                          timeout=TIMEOUT):
+    """GET base_url?query= for each of queries, one at a time"""
+    import aiohttp
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        try:
+            async with session.get(base_url + quote_plus(query),
+                                   timeout=aiohttp.ClientTimeout(timeout)) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            errors[type(exc).__name__] += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        counter[0] += 1
+        if response.status != 200:
+            errors['HTTP {}'.format(response.status)] += 1
+    return latencies
+
+
+def client_queries(queries, connections, total):
+    """split total queries of the cycling mix among connections"""
+    per_client = [total // connections + (i < total % connections)
+                  for i in range(connections)]
+    return [itertools.islice(itertools.cycle(queries), i, i + count)
+            for i, count in enumerate(per_client)]
+
+
+async def load(host, port, connections, depth, total, queries=QUERY_MIX,
+               http=False, path=HTTP_PATH, timeout=TIMEOUT,
+               max_reconnects=RECONNECTS):
+    """return LoadResult of total queries spread over connections"""
+    counter = [0]
+    errors = Counter()
+    reconnects = [0]
+    split = client_queries(queries, connections, total)
+    t0 = time.perf_counter()
+    if http:
+        import aiohttp
+        base_url = 'http://{}:{}{}?query='.format(host, port, path)
+        connector = aiohttp.TCPConnector(limit=connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*(
+                run_http_client(session, base_url, client, counter, errors,
+                                timeout)
+                for client in split))
+    else:
+        results = await asyncio.gather(*(
+            run_client(host, port, client, depth, counter, errors, timeout,
+                       reconnects, max_reconnects)
+            for client in split))
+    elapsed = time.perf_counter() - t0
+    latencies = [latency for client in results for latency in client]
+    return LoadResult(elapsed, latencies, errors, reconnects[0])
+
+
+def run_load(host, port, connections, depth, total):
+    """run load in a new event loop; return (seconds, answers received)"""
+    result = asyncio.run(load(host, port, connections, depth, total))
+    return result.elapsed, len(result.latencies)
+
+
+def wait_ready(host, port, timeout):
+    """poll the server with HEALTH until READY; False after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1) as sock:
+                sock.sendall(b'HEALTH' + CRLF)
+                reply = b''
+                while PROMPT not in reply.partition(PROMPT)[2]:
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        break
+                    reply += chunk
+                if b'READY' in reply:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def report(result):
+    """return dict with throughput, latency percentiles in ms and errors"""
+    latencies = sorted(result.latencies)
+    summary = {'answers': len(latencies),
+               'seconds': round(result.elapsed, 3),
+               'queries_per_second': round(len(latencies) / result.elapsed, 1),
+               'errors': dict(result.errors),
+               'reconnects': result.reconnects}
+    if latencies:
+        summary['latency_ms'] = {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+            **{'p{}'.format(p): round(percentile(latencies, p) * 1000, 3)
+               for p in PERCENTILES},
+            'max': round(latencies[-1] * 1000, 3)}
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', nargs='?', type=int, default=None,
+                        help='default: 2323, or 8888 with --http')
+    parser.add_argument('-c', '--connections', type=int, default=4)
+    parser.add_argument('-d', '--depth', type=int, default=8,
+                        help='queries in flight per TCP connection '
+                             '(default: %(default)s)')
+    parser.add_argument('-n', '--queries', type=int, default=2000,
+                        help='answers to receive in total '
+                             '(default: %(default)s)')
+    parser.add_argument('--mix', metavar='FILE',
+                        help='file of queries to replay, one per line')
+    parser.add_argument('--http', action='store_true',
+                        help='load http_charfinder.py instead')
+    parser.add_argument('--path', default=HTTP_PATH,
+                        help='HTTP route to query (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='seconds to wait for one answer '
+                             '(default: %(default)s)')
+    parser.add_argument('--reconnects', type=int, default=RECONNECTS,
+                        help='times in a row a TCP client connects again '
+                             'after the server closed (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as one JSON object')
+    parser.add_argument('--label', default='',
+                        help='recorded in the JSON report, e.g. the server mode')
+    args = parser.parse_args(argv)
+    if args.port is None:
+        args.port = 8888 if args.http else 2323
+    queries = read_mix(args.mix) if args.mix else QUERY_MIX
+    if not queries:
+        parser.error('no queries in {}'.format(args.mix))
+    result = asyncio.run(load(args.host, args.port, args.connections,
+                              args.depth, args.queries, queries, args.http,
+                              args.path, args.timeout, args.reconnects))
+    summary = report(result)
+    if args.json:
+        options = {name: getattr(args, name) for name in
+                   ('host', 'port', 'connections', 'depth', 'queries', 'mix',
+                    'http', 'path', 'label')}
+        print(json.dumps({'options': options, **summary}))
+    else:
+        print('{} queries in {:.2f}s: {:.1f} queries/s'.format(
+              summary['answers'], result.elapsed,
+              summary['queries_per_second']))
+        if 'latency_ms' in summary:
+            print('latency ms: ' + ', '.join(
+                  '{} {:.2f}'.format(name, value)
+                  for name, value in summary['latency_ms'].items()))
+        if result.reconnects:
+            print('reconnects: {}'.format(result.reconnects))
+        for kind, count in sorted(result.errors.items()):
+            print('errors: {} {}'.format(count, kind))
+    if result.errors:  # exit status 1, for scripts
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Low-overhead instrumentation for the charfinder query path.
+
+``Metrics`` keeps a latency ``Histogram`` per named stage and plain
+counters. Stages are timed with a context manager::
+
+    >>> metrics = Metrics()
+    >>> with metrics.stage('tokenize'):
+    ...     words = 'chess black'.split()
+    >>> metrics.histograms['tokenize'].count
+    1
+
+An index or server without metrics uses ``NO_METRICS``, whose stages do
+nothing. Histograms have fixed buckets, powers of two of microseconds,
+so recording is a bisect and two additions, and snapshots from several
+processes could be added up. ``prometheus()`` renders everything in the
+Prometheus text format, ``report_lines()`` as short lines for humans.
+
+Per-query log messages go through ``start_logging``: records are sampled
+and handed to a queue, and a listener thread writes them, so logging
+never makes the event loop wait for stdout.
+"""
+
+import sys
+import time
+import bisect
+import random
+import logging
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+# upper bounds of the buckets in seconds: 1 µs, 2 µs, 4 µs ... about 16.8 s
+BUCKET_BOUNDS = tuple(2 ** k / 1e6 for k in range(25))
+QUERY_LOGGER = 'charfinder.query'
+LOG_SAMPLE = 0.01  # fraction of per-query log records written
+LOG_FORMAT = '%(asctime)s %(process)d %(message)s'
+
+
+class Histogram:
+    """counts of observed values in buckets with fixed upper bounds"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile, or None
+
+            >>> histogram = Histogram((1, 2, 4))
+            >>> for value in [0.5, 1.5, 1.5, 3, 10]:
+            ...     histogram.observe(value)
+            >>> histogram.quantile(0.5), histogram.quantile(0.99)
+            (2, inf)
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class Stage:
+    """context manager adding its elapsed time to a Metrics histogram"""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """histograms of stage timings and counters, safe to share by threads"""
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.histograms = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()  # queries may run in executor threads
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.bounds)
+            histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report_lines(self):
+        """return one line per counter, then per histogram, times in ms"""
+        with self.lock:
+            lines = ['{} {}'.format(name, count)
+                     for name, count in sorted(self.counters.items())]
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append('{} count {} mean {:.3f} p50 {:.3f} p99 {:.3f}'.format(
+                    name, histogram.count, histogram.mean * 1000,
+                    histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.99) * 1000))
+        return lines
+
+    def prometheus(self, prefix='charfinder'):
+        """return the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, count in sorted(self.counters.items()):
+                metric = '{}_{}_total'.format(prefix, name)
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, count))
+            if self.histograms:
+                metric = '{}_stage_seconds'.format(prefix)
+                lines.append('# HELP {} Time spent in each stage of the '
+                             'query path.'.format(metric))
+                lines.append('# TYPE {} histogram'.format(metric))
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                bounds = [repr(bound) for bound in histogram.bounds] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                        metric, name, bound, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {!r}'.format(
+                    metric, name, histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(
+                    metric, name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics:
+    """metrics that record nothing, for indexes and servers without any"""
+
+    _null_stage = nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def observe(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+
+NO_METRICS = NullMetrics()
+
+
+class SampleFilter(logging.Filter):
+    """let through a random fraction of the records, all of them if 1"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or random.random() < self.rate
+
+
+def start_logging(sample=LOG_SAMPLE, stream=None):
+    """send sampled query log records to stream through a queue
+
+    Return the started QueueListener; stop it to flush the last records.
+    """
+    records = SimpleQueue()
+    logger = logging.getLogger(QUERY_LOGGER)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for handler in logger.handlers[:]:  # after a fork, or started again
+        logger.removeHandler(handler)
+    for old_filter in logger.filters[:]:
+        logger.removeFilter(old_filter)
+    # filtered on the logger, unsampled records are never formatted or queued
+    logger.addFilter(SampleFilter(sample))
+    logger.addHandler(QueueHandler(records))
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,246 @@
+"""Sharded charfinder: the codepoint space split across worker processes.
+
+Each shard process serves a ``ShardIndex``: the postings of the saved
+``CompactNameIndex`` restricted to one range of codepoints. Ranges hold
+about the same number of named chars. Array postings are sliced from the
+shared memory-mapped file without copying.
+
+``ShardedIndex`` is the coordinator: ``find_chars`` sends the query to
+every shard and concatenates their sorted results in shard order, which
+is codepoint order, so ``start`` and ``stop`` mean what they mean for a
+single index::
+
+    >>> with ShardedIndex(2) as index:  # doctest: +SKIP
+    ...     result = index.find_chars('chess black', 0, 3)
+    ...     result.count, ''.join(result.items)
+    (33, '♚♛♜')
+
+Run queries from the command line with ``-n`` shards::
+
+    $ python3 charfinder_shards.py -n 4 chess black
+"""
+
+import os
+import sys
+import bisect
+import itertools
+import threading
+import multiprocessing
+from array import array
+
+from charfinder import (CompactNameIndex, QueryResult, FIRST_CODEPOINT, CRLF,
+                        compact_postings)
+from charfinder_store import BitmapPostings, DescriptionTable
+
+PREFETCH_LIMIT = 100  # with stop <= this, one round trip answers find_chars
+
+
+class ShardError(RuntimeError):
+    """a shard process failed to start or died"""
+
+
+def shard_bounds(codes, shards):
+    """split codepoints in shards ranges holding as many of sorted codes
+
+        >>> shard_bounds(list(range(100, 200)), 4)
+        [(32, 125), (125, 150), (150, 175), (175, 1114112)]
+    """
+    cuts = [codes[len(codes) * i // shards] for i in range(1, shards)]
+    edges = [FIRST_CODEPOINT] + cuts + [sys.maxunicode + 1]
+    return list(zip(edges, edges[1:]))
+
+
+def shard_postings(postings, first, last, threshold):
+    """postings restricted to codepoints in range(first, last)"""
+    if isinstance(postings, BitmapPostings):
+        codes = array('I', itertools.takewhile(lambda code: code < last,
+                                               postings.iter_from(first)))
+        return compact_postings(codes, threshold)
+    lo = bisect.bisect_left(postings, first)
+    return postings[lo:bisect.bisect_left(postings, last, lo)]
+
+
+class ShardIndex(CompactNameIndex):
+    """CompactNameIndex of the saved index chars in range(first, last)
+
+    Nothing is saved: the shard is sliced from the full index each time,
+    and so is its description table.
+    """
+
+    def __init__(self, first, last, **kwargs):
+        self.first = first
+        self.last = last
+        super().__init__(**kwargs)
+
+    def load(self, chars=None):
+        full = CompactNameIndex(sources=self.sources)
+        self.unidata_version = full.unidata_version
+        index = {}
+        for word, postings in full.index.items():
+            postings = shard_postings(postings, self.first, self.last,
+                                      self.bitmap_threshold)
+            if len(postings):
+                index[word] = postings
+        self.index = index
+        # codepoint and character queries are answered from this table
+        table = full.descriptions()
+        lo = bisect.bisect_left(table.codes, self.first)
+        hi = bisect.bisect_left(table.codes, self.last, lo)
+        self._descriptions = DescriptionTable(
+            table.codes[lo:hi], table.offsets[lo:hi + 1], table.text)
+
+    def head(self, query, limit):
+        """return (result count, array of its first limit codepoints)"""
+        result = self.search(query)
+        return len(result), array('I', self.select(result, 0, limit))
+
+    def codes(self, query, start, stop):
+        return array('I', self.select(self.search(query), start, stop))
+
+
+def serve_shard(conn, first, last, kwargs):
+    """shard process: answer (method, args) requests on conn until None"""
+    try:
+        index = ShardIndex(first, last, **kwargs)
+    except Exception as exc:
+        conn.send((False, exc))
+        return
+    conn.send((True, len(index.index)))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:  # coordinator is gone
+            break
+        if request is None:
+            break
+        method, args = request
+        try:
+            reply = True, getattr(index, method)(*args)
+        except Exception as exc:
+            reply = False, exc
+        conn.send(reply)
+    conn.close()
+
+
+class ShardedIndex:
+    """coordinator of shard processes, each with a range of codepoints
+
+    Queries are scattered to all shards at once and gathered in shard
+    order. Concurrent callers are served one query at a time; each query
+    keeps every shard busy. Other keyword arguments, like sources or
+    cache_max_chars, are passed on to each ShardIndex.
+    """
+
+    def __init__(self, shards=None, **kwargs):
+        shards = shards or os.cpu_count()
+        index = CompactNameIndex(**kwargs)  # build the shared file once
+        self.status = index.status
+        self.descriptions = index.descriptions()  # views the mapped file
+        self.bounds = shard_bounds(self.descriptions.codes, shards)
+        del index
+        kwargs.pop('workers', None)
+        self._lock = threading.Lock()
+        self._shards = []
+        for number, (first, last) in enumerate(self.bounds):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve_shard, args=(child_conn, first, last, kwargs),
+                name='charfinder-shard-{}'.format(number), daemon=True)
+            process.start()
+            child_conn.close()
+            self._shards.append((process, conn))
+        try:
+            self.shard_words = self._gather(range(len(self._shards)))
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self._shards)
+
+    def _receive(self, number):
+        try:
+            ok, value = self._shards[number][1].recv()
+        except EOFError:
+            raise ShardError('shard {} exited'.format(number))
+        if not ok:
+            raise value
+        return value
+
+    def _gather(self, numbers):
+        return [self._receive(number) for number in numbers]
+
+    def _scatter(self, requests):
+        """send (shard number, method, args) requests; return the replies"""
+        with self._lock:
+            for number, method, args in requests:
+                self._shards[number][1].send((method, args))
+            return self._gather(number for number, _, _ in requests)
+
+    def find_chars(self, query, start=0, stop=None):
+        limit = 0 if stop is None else min(stop, PREFETCH_LIMIT)
+        heads = self._scatter([(number, 'head', (query, limit))
+                               for number in range(len(self))])
+        total = sum(count for count, _ in heads)
+        if not total:
+            return QueryResult(0, ())
+        stop = total if stop is None else min(stop, total)
+        parts = {}
+        requests = []
+        offset = 0
+        for number, (count, head) in enumerate(heads):
+            lo, hi = max(start - offset, 0), min(stop - offset, count)
+            if lo < hi <= len(head):
+                parts[number] = head[lo:hi]
+            elif lo < hi:
+                requests.append((number, 'codes', (query, lo, hi)))
+            offset += count
+        if requests:
+            replies = self._scatter(requests)
+            parts.update(zip((number for number, _, _ in requests), replies))
+        codes = itertools.chain.from_iterable(parts[number]
+                                              for number in sorted(parts))
+        return QueryResult(total, map(chr, codes))
+
+    def find_description_strs(self, query, start=0, stop=None):
+        chars = self.find_chars(query, start, stop).items
+        for line in self.descriptions.lines(map(ord, chars)):
+            yield line[:-len(CRLF)].decode('utf-8')
+
+    def close(self):
+        with self._lock:
+            for process, conn in self._shards:
+                try:
+                    conn.send(None)
+                except OSError:  # already gone
+                    pass
+                conn.close()
+            for process, _ in self._shards:
+                process.join()
+            self._shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(*args, shards=None):
+    with ShardedIndex(shards) as index:
+        query = ' '.join(args)
+        n = 0
+        for n, line in enumerate(index.find_description_strs(query), 1):
+            print(line)
+        print('({})'.format(index.status(query, n)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Find Unicode characters with a sharded index.')
+    parser.add_argument('words', nargs='+', metavar='word')
+    parser.add_argument('-n', '--shards', type=int, default=None,
+                        help='shard processes (default: CPU count)')
+    args = parser.parse_args()
+    main(*args.words, shards=args.shards)
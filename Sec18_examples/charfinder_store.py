@@ -0,0 +1,461 @@
+"""Binary, memory-mapped file format for the charfinder index.
+
+Layout (native byte order, recorded in the header)::
+
+    header     magic, format version, byte order, unidata version,
+               number of sections
+    directory  one (tag, offset, length) entry per section
+    sections   WORD  word table: (word_offset, word_len, postings_offset,
+                     postings_count, postings_kind) per word, sorted
+               TEXT  ASCII bytes of all words, concatenated
+               POST  postings, 4-byte aligned; kind ARRAY: sorted uint32
+                     codepoints; kind BITMAP: uint32 chunk count, uint32
+                     chunk numbers, then one bitmap of 2**16 bits per chunk
+               DCOD  sorted uint32 codepoints of all named chars
+               DOFF  uint32 offset of each description line in DTXT,
+                     plus the end offset
+               DTXT  UTF-8 description lines, each ending with CRLF
+               RANK  uint32 positions in the word table of all words, by
+                     descending postings count; optional
+
+``MappedIndex`` opens the file with ``mmap`` and looks words up by binary
+search over the word table, so opening costs a few system calls and every
+process that maps the same file shares one page-cached copy.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+from array import array
+from collections import abc
+
+MAGIC = b'CHARIDX\0'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('=8sHH16sI')
+SECTION = struct.Struct('=4sQQ')
+WORD_FIELDS = 5  # word_offset, word_len, postings_offset, count, kind
+ARRAY, BITMAP = 0, 1  # postings kinds
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_BYTES = CHUNK_SIZE // 8
+ITER_BLOCK_BYTES = 256
+# positions of the bits set in each byte value, to walk bitmaps quickly
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1)
+                  for byte in range(256))
+BYTE_ORDERS = {'little': 1, 'big': 2}
+
+
+class IndexFormatError(ValueError):
+    """file is not a usable index: bad magic, format, byte order or sizes"""
+
+
+class BitmapPostings:
+    """codepoints as bitmaps of 2**16 codepoints per chunk, roaring style
+
+    Meant for frequent words: intersections and differences of two
+    bitmaps are bitwise operations on whole chunks, and membership tests
+    are O(1). Iteration yields codepoints in ascending order::
+
+        >>> a = array('I', [5, 8, 70000, 70001, 131072])
+        >>> b = array('I', [8, 9, 70001])
+        >>> bits_a = BitmapPostings.from_codes(a)
+        >>> bits_b = BitmapPostings.from_codes(b)
+        >>> list(bits_a & bits_b), list(bits_a - bits_b)
+        ([8, 70001], [5, 70000, 131072])
+        >>> list(bits_a | bits_b)
+        [5, 8, 9, 70000, 70001, 131072]
+        >>> len(bits_a), 70001 in bits_a, 70002 in bits_a
+        (5, True, False)
+        >>> list(bits_a.iter_from(6))  # 5 and 8 share the first byte
+        [8, 70000, 70001, 131072]
+        >>> list(bits_a.iter_from(70001))
+        [70001, 131072]
+
+    The same as set operations on the arrays, over many chunks::
+
+        >>> odd = array('I', range(1, 300000, 2))
+        >>> tens = array('I', range(0, 300000, 10))
+        >>> bits_odd = BitmapPostings.from_codes(odd)
+        >>> bits_tens = BitmapPostings.from_codes(tens)
+        >>> list(bits_odd | bits_tens) == sorted(set(odd) | set(tens))
+        True
+        >>> list(bits_tens - bits_odd) == list(tens)
+        True
+        >>> list(bits_odd & bits_tens)
+        []
+        >>> list(bits_odd.iter_from(250001)) == [c for c in odd if c >= 250001]
+        True
+
+    ``from_buffer`` views the bytes of ``to_bytes``, as in a mapped file::
+
+        >>> buf = memoryview(bits_a.to_bytes())
+        >>> list(BitmapPostings.from_buffer(buf, len(bits_a))) == list(a)
+        True
+    """
+
+    __slots__ = ('chunks', 'count')
+
+    def __init__(self, chunks, count=None):
+        self.chunks = chunks  # chunk number -> CHUNK_BYTES bytes-like
+        if count is None:
+            count = sum(int.from_bytes(chunk, 'little').bit_count()
+                        for chunk in chunks.values())
+        self.count = count
+
+    @classmethod
+    def from_codes(cls, codes):
+        chunks = {}
+        for code in codes:
+            chunk = chunks.get(code >> CHUNK_BITS)
+            if chunk is None:
+                chunk = chunks[code >> CHUNK_BITS] = bytearray(CHUNK_BYTES)
+            low = code & (CHUNK_SIZE - 1)
+            chunk[low >> 3] |= 1 << (low & 7)
+        return cls({key: bytes(chunk) for key, chunk in chunks.items()})
+
+    @classmethod
+    def from_buffer(cls, buf, count):
+        """BitmapPostings viewing buf, as written by to_bytes"""
+        size = buf[:4].cast('I')[0]
+        keys = buf[4:4 + 4 * size].cast('I')
+        start = 4 + 4 * size
+        chunks = {key: buf[start + i * CHUNK_BYTES:
+                           start + (i + 1) * CHUNK_BYTES]
+                  for i, key in enumerate(keys)}
+        return cls(chunks, count)
+
+    def to_bytes(self):
+        keys = sorted(self.chunks)
+        return (array('I', [len(keys)] + keys).tobytes() +
+                b''.join(bytes(self.chunks[key]) for key in keys))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, code):
+        chunk = self.chunks.get(code >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = code & (CHUNK_SIZE - 1)
+        return chunk[low >> 3] >> (low & 7) & 1 == 1
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, first_code):
+        """yield codepoints >= first_code in ascending order"""
+        for key in sorted(self.chunks):
+            base = key << CHUNK_BITS
+            if base + CHUNK_SIZE <= first_code:
+                continue
+            chunk = self.chunks[key]
+            # decode a block of bytes at a time: fast, yet lazy enough to page
+            for start in range(max(first_code - base, 0) >> 3, CHUNK_BYTES,
+                               ITER_BLOCK_BYTES):
+                block_base = base + (start << 3)
+                codes = [block_base + (i << 3) + bit for i, byte in
+                         enumerate(chunk[start:start + ITER_BLOCK_BYTES])
+                         if byte for bit in BYTE_BITS[byte]]
+                if codes and codes[0] < first_code:  # first byte is partial
+                    codes = [code for code in codes if code >= first_code]
+                yield from codes
+
+    def _combine(self, keys, other, operator):
+        chunks = {}
+        for key in keys:
+            bits = operator(int.from_bytes(self.chunks.get(key, b''), 'little'),
+                            int.from_bytes(other.chunks.get(key, b''), 'little'))
+            if bits:
+                chunks[key] = bits.to_bytes(CHUNK_BYTES, 'little')
+        return BitmapPostings(chunks)
+
+    def __and__(self, other):
+        return self._combine(self.chunks.keys() & other.chunks.keys(), other,
+                             lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self._combine(self.chunks.keys() | other.chunks.keys(), other,
+                             lambda a, b: a | b)
+
+    def __sub__(self, other):
+        return self._combine(self.chunks.keys(), other, lambda a, b: a & ~b)
+
+
+class DescriptionTable:
+    """pre-encoded description lines of named chars, by codepoint"""
+
+    def __init__(self, codes, offsets, text):
+        self.codes = codes
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        i = bisect.bisect_left(self.codes, code)
+        return i < len(self.codes) and self.codes[i] == code
+
+    def line(self, code):
+        """return bytes of the description line of code; KeyError if none"""
+        i = bisect.bisect_left(self.codes, code)
+        if i == len(self.codes) or self.codes[i] != code:
+            raise KeyError(code)
+        return bytes(self.text[self.offsets[i]:self.offsets[i + 1]])
+
+    def lines(self, codes):
+        """yield description lines of sorted codes, skipping unnamed ones"""
+        table, offsets, text = self.codes, self.offsets, self.text
+        size = len(table)
+        i = 0
+        for code in codes:
+            if i < size and table[i] != code:  # runs need no search
+                i = bisect.bisect_left(table, code, i)
+            if i == size:
+                break
+            if table[i] == code:
+                yield bytes(text[offsets[i]:offsets[i + 1]])
+                i += 1
+
+
+def _align(blob, size=4):
+    blob.extend(b'\0' * (-len(blob) % size))
+
+
+def write_index(path, index, unidata_version, descriptions, ranks=None):
+    """write word -> sorted codepoints mapping and DescriptionTable to path
+
+    ranks, if given, are positions of words in sorted order, see RANK.
+    The file is replaced atomically.
+    """
+    words = sorted(index)
+    text = bytearray()
+    table = array('I')
+    postings = bytearray()
+    for word in words:
+        codes = index[word]
+        encoded = word.encode('ascii')
+        if isinstance(codes, BitmapPostings):
+            kind, data = BITMAP, codes.to_bytes()
+        elif isinstance(codes, (array, memoryview)):
+            kind, data = ARRAY, codes  # raw uint32 bytes, by buffer protocol
+        else:
+            kind, data = ARRAY, array('I', codes)
+        table.extend((len(text), len(encoded), len(postings), len(codes), kind))
+        text.extend(encoded)
+        postings += data
+
+    sections = [(b'WORD', table.tobytes()), (b'TEXT', bytes(text)),
+                (b'POST', bytes(postings)),
+                (b'DCOD', array('I', descriptions.codes).tobytes()),
+                (b'DOFF', array('I', descriptions.offsets).tobytes()),
+                (b'DTXT', bytes(descriptions.text))]
+    if ranks is not None:
+        sections.append((b'RANK', array('I', ranks).tobytes()))
+    blob = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION,
+                                 BYTE_ORDERS[sys.byteorder],
+                                 unidata_version.encode('ascii'),
+                                 len(sections)))
+    directory_pos = len(blob)
+    blob.extend(b'\0' * SECTION.size * len(sections))
+    _align(blob)
+    for i, (tag, data) in enumerate(sections):
+        SECTION.pack_into(blob, directory_pos + i * SECTION.size,
+                          tag, len(blob), len(data))
+        blob.extend(data)
+        _align(blob)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(blob)
+    # replace, never truncate: workers may still have the old file mapped
+    os.replace(tmp_path, path)
+
+
+def read_header(buf):
+    """return (unidata_version, {tag: memoryview}) from buf
+
+    Sections must lie within buf: slicing would silently cut them short.
+    """
+    if len(buf) < HEADER.size:
+        raise IndexFormatError('file too short')
+    magic, version, byte_order, unidata, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise IndexFormatError('bad magic: {!r}'.format(magic))
+    if version != FORMAT_VERSION:
+        raise IndexFormatError('format version {} != {}'
+                               .format(version, FORMAT_VERSION))
+    if byte_order != BYTE_ORDERS[sys.byteorder]:
+        raise IndexFormatError('byte order mismatch')
+    if HEADER.size + count * SECTION.size > len(buf):
+        raise IndexFormatError('directory past end of file')
+    view = memoryview(buf)
+    sections = {}
+    for i in range(count):
+        tag, offset, length = SECTION.unpack_from(
+            buf, HEADER.size + i * SECTION.size)
+        if offset + length > len(buf):
+            raise IndexFormatError('section {} past end of file: {} > {}'
+                                   .format(tag.decode('ascii', 'replace'),
+                                           offset + length, len(buf)))
+        sections[tag] = view[offset:offset + length]
+    return unidata.rstrip(b'\0').decode('ascii'), sections
+
+
+class _WordKeys(abc.Sequence):
+    """the sorted words of a word table, as bytes, for bisect"""
+
+    def __init__(self, table, text):
+        self.table = table
+        self.text = text
+
+    def __len__(self):
+        return len(self.table) // WORD_FIELDS
+
+    def __getitem__(self, i):
+        pos = i * WORD_FIELDS
+        start = self.table[pos]
+        return self.text[start:start + self.table[pos + 1]].tobytes()
+
+
+class _WordStrs(_WordKeys):
+    """the sorted words of a word table, as str"""
+
+    def __getitem__(self, i):
+        return super().__getitem__(i).decode('ascii')
+
+
+class _MappedItems(abc.ItemsView):
+    """walk the word table in order, without a binary search per word"""
+
+    def __iter__(self):
+        index = self._mapping
+        for i, key in enumerate(index._keys):
+            yield key.decode('ascii'), index._postings_at(i)
+
+
+class _MappedValues(abc.ValuesView):
+
+    def __iter__(self):
+        index = self._mapping
+        for i in range(len(index)):
+            yield index._postings_at(i)
+
+
+class MappedIndex(abc.Mapping):
+    """read-only mapping of word -> postings viewing the mapped file
+
+    Postings are memoryviews of uint32 codepoints, or BitmapPostings.
+    ``words`` and ``counts`` view the sorted words and their postings
+    counts; ``ranks`` is the RANK section, or None if the file has none.
+    What ``write_index`` writes reads back the same::
+
+        >>> import os, tempfile
+        >>> index = {'SIGN': array('I', [36, 65, 8364]),
+        ...          'DOLLAR': [36],
+        ...          'EURO': BitmapPostings.from_codes([8364])}
+        >>> lines = [b'U+0024\\t$\\tDOLLAR SIGN\\r\\n',
+        ...          b'U+0041\\tA\\tLATIN CAPITAL LETTER A\\r\\n']
+        >>> offsets = [0, len(lines[0]), len(lines[0]) + len(lines[1])]
+        >>> table = DescriptionTable([36, 65], offsets, b''.join(lines))
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(tmp.name, 'index.bin')
+        >>> write_index(path, index, '14.0.0', table, ranks=[2, 0, 1])
+        >>> mapped = MappedIndex(path)
+        >>> mapped.unidata_version, list(mapped), list(mapped.counts)
+        ('14.0.0', ['DOLLAR', 'EURO', 'SIGN'], [1, 1, 3])
+        >>> all(list(mapped[word]) == list(index[word]) for word in index)
+        True
+        >>> type(mapped['EURO']).__name__, 'CENT' in mapped
+        ('BitmapPostings', False)
+        >>> list(mapped.ranks)
+        [2, 0, 1]
+        >>> list(mapped.descriptions.lines([36, 37, 65])) == lines
+        True
+        >>> tmp.cleanup()
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            try:
+                self._mmap = mmap.mmap(fp.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError as exc:  # empty file
+                raise IndexFormatError(exc)
+        self.unidata_version, sections = read_header(self._mmap)
+        entry_sizes = {b'WORD': WORD_FIELDS * 4, b'DCOD': 4, b'DOFF': 4,
+                       b'RANK': 4}
+        for tag, size in entry_sizes.items():
+            if len(sections.get(tag, b'')) % size:
+                raise IndexFormatError('section {} has a partial entry'
+                                       .format(tag.decode('ascii')))
+        try:
+            self._table = sections[b'WORD'].cast('I')
+            self._keys = _WordKeys(self._table, sections[b'TEXT'])
+            self._postings = sections[b'POST']
+            self.words = _WordStrs(self._table, sections[b'TEXT'])
+            self.counts = self._table[3::WORD_FIELDS]
+            self.descriptions = DescriptionTable(sections[b'DCOD'].cast('I'),
+                                                 sections[b'DOFF'].cast('I'),
+                                                 sections[b'DTXT'])
+        except KeyError as exc:
+            raise IndexFormatError('missing section: {}'.format(exc))
+        ranks = sections.get(b'RANK')
+        self.ranks = None if ranks is None else ranks.cast('I')
+        self._check_sizes()
+
+    def _check_sizes(self):
+        """raise IndexFormatError unless the sections agree in length"""
+        codes, offsets, text = (self.descriptions.codes,
+                                self.descriptions.offsets,
+                                self.descriptions.text)
+        if len(offsets) != len(codes) + 1 or offsets[-1] != len(text):
+            raise IndexFormatError('description sections disagree: '
+                                   '{} codes, {} offsets, {} text bytes'
+                                   .format(len(codes), len(offsets),
+                                           len(text)))
+        if self.ranks is not None and len(self.ranks) != len(self):
+            raise IndexFormatError('{} ranks for {} words'
+                                   .format(len(self.ranks), len(self)))
+
+    def _find(self, word):
+        try:
+            key = word.encode('ascii')
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return None
+
+    def _postings_at(self, i):
+        pos = i * WORD_FIELDS
+        offset, count, kind = self._table[pos + 2:pos + 5]
+        if kind == BITMAP:
+            return BitmapPostings.from_buffer(self._postings[offset:], count)
+        return self._postings[offset:offset + count * 4].cast('I')
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i is None:
+            raise KeyError(word)
+        return self._postings_at(i)
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for key in self._keys:
+            yield key.decode('ascii')
+
+    def items(self):
+        return _MappedItems(self)
+
+    def values(self):
+        return _MappedValues(self)
+
@@ -1,26 +1,96 @@
 # http_charfinder.py: the main and init functions
 
-@asyncio.coroutine
-# the init coroutine yields a server for the event loop to drive
-def init(loop, address, port):
+import sys
+import time
+import json
+import asyncio
+import hashlib
+import logging
+import functools
+from html import escape
+from urllib.parse import quote_plus
+
+from aiohttp import web
+
+from charfinder import CompactNameIndex, LazyIndex, QueryRunner, query_key, ROW_COST
+from charfinder_metrics import Metrics, start_logging, QUERY_LOGGER, LOG_SAMPLE
+
+CONTENT_TYPE = 'text/html'
+CHARSET = 'utf-8'
+
+# every value put into these templates is HTML escaped first: the query and literal chars like < or " come from the client
+ROW_TPL = '<tr><td>{code_str}</td><th>{char}</th><td>{name}</td></tr>'
+
+# the page is sent in chunks: this head, the table rows in batches, then the tail with the status message, known only at the end
+TEMPLATE_HEAD = '''<!DOCTYPE html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8">
+    <title>Charfinder</title>
+  </head>
+  <body>
+    <p>
+      <form action="/">
+        <input type="search" name="query" value="{query}">
+        <input type="submit" value="find">
+      </form>
+    </p>
+    <table>
+'''
+
+TEMPLATE_TAIL = '''
+    </table>
+    <hr>
+    <p>{message}</p>
+  </body>
+</html>
+'''
+
+# histograms of the time spent in each stage of the query path, served by GET /metrics
+metrics = Metrics()
+# the index loads in a background thread; the server starts right away and /health reports when it is ready
+index = LazyIndex(CompactNameIndex, metrics=metrics)
+# cheap queries are answered on the event loop, expensive ones (by their estimated cost: postings entries read plus ROW_COST per row formatted) in the default thread pool
+query_runner = QueryRunner(index, metrics=metrics)
+# per-query log records are sampled and written by a thread, see start_logging in main
+log = logging.getLogger(QUERY_LOGGER)
+# seconds a page request waits for the index before answering 503
+READY_TIMEOUT = 2.0
+# seconds an idle connection is kept open for the next request of the same client, instead of a new TCP handshake per request
+KEEPALIVE_TIMEOUT = 75
+
+# the init coroutine starts a server for the event loop to drive
+async def init(address, port):
     # the aiohttp.web.Application class represents a Web application ...
-    app = web.Application(loop=loop)
+    app = web.Application()
     # ... with routes mapping URL patterns to handler functions; here GET / is routed to the home function
-    app.route.add_route('GET', '/home')
-    # the app.make_handler method returns an aiohttp.web.RequestHandler instance to handle HTTP requests according to the routes set up in the app object
-    handler = app.make_handler
-    # create_server brings up the server, using handler as the protocol handler and binding it to address and port
-    server = yield from loop.create_server(handler, address, port)
+    app.router.add_route('GET', '/', home)
+    # GET /health answers 200 when the index is loaded and 503 while it is loading
+    app.router.add_route('GET', '/health', health)
+    # GET /api/find answers the same queries as JSON or NDJSON, for programs instead of browsers
+    app.router.add_route('GET', '/api/find', api_find)
+    # GET /metrics answers the stage histograms and counters for Prometheus
+    app.router.add_route('GET', '/metrics', metrics_page)
+    # the AppRunner sets up the request handling for the routes set up in the app object
+    # HTTP/1.1 connections are kept alive between requests for keepalive_timeout seconds
+    runner = web.AppRunner(app, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    await runner.setup()
+    # TCPSite brings up the server, binding it to address and port
+    site = web.TCPSite(runner, address, port)
+    await site.start()
 
-    # return the address and port of the first server socket
-    return server.sockets[0].getsockname()
+    # return the runner, to clean up on exit, and the address and port of the first server socket
+    return runner, runner.addresses[0]
 
 
-def main(address="127.0.0.1", port=8888):
+def main(address="127.0.0.1", port=8888, log_sample=LOG_SAMPLE):
     port = int(port)
-    loop = asyncio.get_event_loop()
+    # the logging thread writes a log_sample fraction of the per-query records, so the handlers never wait for stdout
+    listener = start_logging(float(log_sample))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     # run init to start the server and get its address and port
-    host = loop.run_until_complete(init(loop, address, port))
+    runner, host = loop.run_until_complete(init(address, port))
     print('Serving on {}. Hit CTRL-C to stop.'.format(host))
     try:
         # run the event loop; main will block here while the event loop is in control
@@ -28,12 +98,12 @@ def main(address="127.0.0.1", port=8888):
     # CTRL + C pressed
     except KeyboardInterrupt:
         pass
-    # close the event loop
+    # close the server and the event loop
+    loop.run_until_complete(runner.cleanup())
     loop.close()
-
-if __name__ == "__main__":
-    main(*sys.argv[1:])
-
+    listener.stop()
+    # totals of the query timings: how long queries took and how long they blocked the event loop
+    print(query_runner.report())
 
 '''
 try contrasting how the servers are set up in http_charfinder.py and tcp_charfinder.py
@@ -43,9 +113,11 @@ note: in the tcp example, the server was created and scheduled to run in the mai
     server = loop.run_until_complete(server_coro)
 
 note: in the http example, the init function creates the server:
-    server = yield from loop.create_server(handler, address, port)
-    *init itself is a coroutine and is ran by the main() function
-        host = loop.run_until_complete(init(loop, address, port))
+    site = web.TCPSite(runner, address, port)
+    await site.start()
+    *init itself is a coroutine (async def) and is ran by the main() function
+        runner, host = loop.run_until_complete(init(address, port))
+    *newer aiohttp versions replaced app.make_handler + loop.create_server with AppRunner + TCPSite
 
 BOTH asyncio.start_server and loop.create_server are coroutines that return asyncio.Server objects that are driven to completion in order to start up a server
 
@@ -56,31 +128,244 @@ take a look at the home function below
 
 # http_charfinder.py (continued): home function (configured to handle the / root URL in our HTTP server)
 
+PAGE_SIZE = 100
+# most rows one response may hold, whatever size the client asks for with ?size=
+MAX_RESULTS = 10000
+# rows rendered and written per chunk: memory per request is bounded by this, not by the size of the result
+STREAM_BATCH = 500
+# link to the next page; the cursor is the codepoint of the last char shown
+NEXT_TPL = ' <a href="/?query={query}&cursor={cursor}{size}">next page</a>'
+
+# the health check does not wait: it only reports whether the loader thread is done
+def health(request):
+    if index.ready:
+        return web.Response(text='READY')
+    return web.Response(status=503, text='LOADING')
+
+
+# one batch of table rows as bytes, their number and the cursor after them; this is the work query_runner may hand to a thread
+def render_rows(query, cursor, size):
+    try:
+        # find_page walks the ordered postings only as far as the page needs, instead of sorting the whole result
+        page = index.find_page(query, cursor, size)
+    except ValueError:  # malformed cursor: start over
+        page = index.find_page(query, None, size)
+    with metrics.stage('format'):
+        rows = ''.join(ROW_TPL.format(code_str=escape(code_str), char=escape(char), name=escape(name)) + '\n'
+                       for code_str, char, name in index.get_descriptions(page.items)).encode(CHARSET)
+    return rows, len(page.items), page.cursor
+
+
+# the size parameter: rows to show, PAGE_SIZE if absent or malformed, at most MAX_RESULTS
+def page_size(request):
+    try:
+        size = int(request.query.get('size', PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+    return max(1, min(size, MAX_RESULTS))
+
+
+# the message under the table: the number of matches when the first page holds them all; otherwise only the rows of this page are known, the rest were never computed
+def page_status(query, count, first_page, last_page):
+    if first_page and last_page:
+        return index.status(query, count)
+    if not count:
+        return 'No more rows for {!r}'.format(query)
+    rows = '1 row' if count == 1 else '{} rows'.format(count)
+    if last_page:
+        return 'Last {} for {!r}'.format(rows, query)
+    return '{} for {!r}, more follow:'.format(rows, query)
+
+
+# early requests wait for the index in an executor thread, so the event loop is not blocked; False if still loading after READY_TIMEOUT
+async def index_ready():
+    if index.ready:
+        return True
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, index.wait_ready, READY_TIMEOUT)
+
+
 # a route handler receives an aiohttp.web.Request instance
-def home(request):
+async def home(request):
     # get the query string stripped of leading and trailing blanks
-    query = request.GET.get('query', '').strip()
-    # log query to server console 
-    print('Query: {!r}'.format(query))
-    # if there was a query, bind res to HTML table rows rendered from result of the query to the index, and msg to a status message
-    if query:
-        descriptions = list(index.find_descriptions(query))
-        res = '\n'.join(ROW_TPL.format(**vars(descr)) for descr in descriptions)
-        msg = index.status(query, len(descriptions))
-    else:
-        descriptions = []
-        res = ''
-        msg = 'Enter words describing characters.'
-
-    # render the html page
-    html = template.format(query=query, result=res, message=msg)
-
-    # log response to server console
-    print('Sending {} results'.format(len(descriptions)))
-    # build Response and return it
-    return web.Response(content_type=CONTENT_TYPE, text=html)
+    query = request.query.get('query', '').strip()
+    # the cursor of the page to show; absent for the first page
+    cursor = request.query.get('cursor') or None
+    size = page_size(request)
+    if query and not await index_ready():
+        return web.Response(status=503, text='Index still loading, try again shortly.')
+    # a StreamResponse sends its headers on prepare and its body as it is written; with chunked encoding no Content-Length is needed up front
+    response = web.StreamResponse()
+    response.content_type = CONTENT_TYPE
+    response.charset = CHARSET
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    # the head goes out first, so the browser starts rendering before any query work is done
+    await response.write(TEMPLATE_HEAD.format(query=escape(query)).encode(CHARSET))
+    first_page = cursor is None
+    count = 0
+    blocking = 0.0
+    t0 = time.perf_counter()
+    try:
+        # stream the rows STREAM_BATCH at a time, each batch continuing from the cursor of the one before
+        while query and count < size:
+            # query_runner calls render_rows right here if the query is cheap, or awaits it in an executor thread
+            batch = min(STREAM_BATCH, size - count)
+            # the cost of a batch: finding its rows lazily, then formatting them
+            cost = index.query_cost(query, batch) + batch * ROW_COST
+            rows, batch_count, cursor = await query_runner.run(
+                asyncio.get_running_loop(), query, render_rows, query, cursor, batch, cost=cost)
+            blocking += query_runner.timings[-1].blocking
+            count += batch_count
+            # write awaits while the transport buffer is full, so a slow client holds at most a few batches in memory
+            await response.write(rows)
+            if cursor is None:
+                break
+        if query:
+            msg = escape(page_status(query, count, first_page, cursor is None))
+            # the cursor goes back to us in the "next page" link
+            if cursor is not None:
+                msg += NEXT_TPL.format(query=quote_plus(query), cursor=cursor,
+                                       size='' if size == PAGE_SIZE else '&size={}'.format(size))
+        else:
+            msg = 'Enter words describing characters.'
+        await response.write(TEMPLATE_TAIL.format(message=msg).encode(CHARSET))
+        await response.write_eof()
+    # the client went away mid-stream: stop rendering rows for it
+    except ConnectionResetError:
+        log.info('%r: client gone after %d results', query, count)
+        return response
+    # log the response, with the time the event loop could not serve other requests; the arguments are formatted only if the record is sampled
+    log.info('%r: sent %d results in %.2f ms (loop blocked %.2f ms)',
+             query, count, (time.perf_counter() - t0) * 1000, blocking * 1000)
+    return response
 
 
 '''
-note: home() is NOT a coroutine and does NOT need to be if there are NO  "yield from" expressions in it
-'''
\ No newline at end of file
+note: home() was originally a plain function: it does NOT need to be a coroutine if there are NO "yield from"/await expressions in it
+    it is a coroutine now because early requests await the background index loader, and expensive queries await an executor thread
+    a broad query like 'U+0000..U+10FFFF' computed right in the handler would stall every other request until done
+
+streaming: home returns a StreamResponse written in chunks instead of a Response holding the whole page
+    the head is sent before the query runs, so the time to first byte does not grow with the result
+    rows are rendered and written STREAM_BATCH at a time, so a 'cjk' page of MAX_RESULTS rows never sits in memory as one string
+    ?size= asks for up to MAX_RESULTS rows; the "next page" link carries the cursor, and the size if not the default
+'''
+
+# http_charfinder.py (continued): the JSON API, GET /api/find?query=chess+black&start=0&stop=10
+
+JSON_TYPE = 'application/json'
+# NDJSON: one JSON object per line, so a client can handle each result as it reads it
+NDJSON_TYPE = 'application/x-ndjson'
+# the keys of a result object: {"code": "U+265A", "char": "♚", "name": "BLACK CHESS KING"}
+API_FIELDS = ('code', 'char', 'name')
+# seconds clients and proxies may reuse a result without asking again; after that they revalidate it with If-None-Match
+CACHE_MAX_AGE = 3600
+
+
+# the index version: results change only when the index is rebuilt for another Unicode version or with other name sources
+def index_version():
+    return '{}:{}'.format(index.unidata_version, ','.join(source.name for source in index.sources))
+
+
+# the ETag of an answer: the normalized query, so 'Black  CHESS' and 'chess black' share it, the page and the format
+def result_etag(query, start, stop, ndjson):
+    key = repr((index_version(), query_key(query), start, stop, ndjson))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+# the response body and the total number of results; this is the work query_runner may hand to a thread
+# the description lines are precomputed bytes like b'U+0039 \t9\tDIGIT NINE\r\n'; their fields become the result objects
+# only the code is stripped: the char is everything between the first and the last tab, so blanks like U+0020 or U+3000 are kept
+def api_row(line):
+    code, _, rest = line.decode(CHARSET).rstrip('\r\n').partition('\t')
+    char, _, name = rest.rpartition('\t')
+    return dict(zip(API_FIELDS, (code.strip(), char, name)))
+
+
+def render_api(query, start, stop, ndjson):
+    result = index.find_chars(query, start, stop)
+    with metrics.stage('format'):
+        rows = [api_row(line) for line in index.describe_lines(result.items)]
+        # separators without blanks make compact JSON; ensure_ascii=False keeps the chars themselves instead of \u escapes
+        dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+        if ndjson:
+            body = ''.join(dumps(row) + '\n' for row in rows)
+        else:
+            body = dumps({'query': query, 'count': result.count, 'start': start, 'stop': stop, 'results': rows})
+        body = body.encode(CHARSET)
+    return body, result.count
+
+
+def api_error(status, message):
+    return web.json_response({'error': message}, status=status)
+
+
+async def api_find(request):
+    query = request.query.get('query', '').strip()
+    if not query:
+        return api_error(400, 'missing query')
+    # start and stop select results as in a slice; stop is capped, so one request holds at most MAX_RESULTS results
+    try:
+        start = max(0, int(request.query.get('start', 0)))
+        stop = int(request.query.get('stop', start + PAGE_SIZE))
+    except ValueError:
+        return api_error(400, 'start and stop must be integers')
+    stop = max(start, min(stop, start + MAX_RESULTS))
+    # NDJSON with ?format=ndjson or when the Accept header asks for it; JSON otherwise
+    ndjson = (request.query.get('format') == 'ndjson' or
+              NDJSON_TYPE in request.headers.get('Accept', ''))
+    if not await index_ready():
+        return api_error(503, 'index still loading, try again shortly')
+    etag = result_etag(query, start, stop, ndjson)
+    headers = {'Cache-Control': 'public, max-age={}'.format(CACHE_MAX_AGE),
+               # the format depends on the Accept header, so caches must keep one entry per Accept value
+               'Vary': 'Accept'}
+    # a conditional request with the ETag the client already has is answered 304 Not Modified, without running the query
+    if any(tag.value == etag for tag in request.if_none_match or ()):
+        metrics.count('not_modified')
+        log.info('API %r: not modified', query)
+        response = web.Response(status=304, headers=headers)
+        response.etag = etag
+        return response
+    # find_chars computes the whole result (size None), select skips to start one result at a time, then stop - start rows are formatted
+    cost = index.query_cost(query, None) + stop + (stop - start) * ROW_COST
+    body, count = await query_runner.run(asyncio.get_running_loop(), query, render_api, query, start, stop, ndjson,
+                                         cost=cost)
+    # a body of known length gets a Content-Length header, so the connection stays open for the next request
+    response = web.Response(body=body, headers=headers, content_type=NDJSON_TYPE if ndjson else JSON_TYPE,
+                            charset=CHARSET)
+    response.etag = etag
+    response.headers['X-Result-Count'] = str(count)
+    log.info('API %r: %d of %d results', query, max(0, min(stop, count) - start), count)
+    return response
+
+
+'''
+note: the HTML page is for people; programs get the same results from /api/find without parsing any HTML
+    clients reusing one connection (keep-alive) save a TCP handshake per request
+    the ETag depends only on the index version and the normalized query, so it is known BEFORE the query runs: a conditional request costs no query work at all
+'''
+
+# http_charfinder.py (continued): GET /metrics in the Prometheus text format
+
+# a stage histogram has one line per bucket, with the count of observations up to its bound:
+#   charfinder_stage_seconds_bucket{stage="intersect",le="0.000128"} 311
+# the result cache counters are read from the index at each scrape
+async def metrics_page(request):
+    lines = [metrics.prometheus()]
+    if index.ready:
+        cache = index.cache.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            lines.append('# TYPE charfinder_cache_{0}_total counter\ncharfinder_cache_{0}_total {1}\n'.format(
+                name, getattr(cache, name)))
+        for name in ('entries', 'chars'):
+            lines.append('# TYPE charfinder_cache_{0} gauge\ncharfinder_cache_{0} {1}\n'.format(
+                name, getattr(cache, name)))
+    return web.Response(text=''.join(lines), content_type='text/plain', charset=CHARSET,
+                        headers={'Cache-Control': 'no-store'})
+
+
+# main is called at the very end, after all the handlers are defined
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -1,120 +1,592 @@
-# tcp_charfinder.py (part 1) - A simple TCP server using asyncio.start_server 
+# tcp_charfinder.py (part 1) - A simple TCP server using asyncio.start_server
 
 ''' part 1 '''
 
+import os
 import sys
+import time
+import signal
 import asyncio
-# UnicodeNameIndex is the class that builds the index of names and provides querying methods
-from charfinder import UnicodeNameIndex
+import logging
+import argparse
+import functools
+import multiprocessing
+from collections import Counter, namedtuple
+from concurrent import futures
+# CompactNameIndex builds the index of names and provides querying methods; its postings live in a memory-mapped file
+# LazyIndex loads it in a background thread, so the server accepts connections right away
+# QueryRunner answers cheap queries on the event loop and hands expensive ones to an executor, timing both
+from charfinder import CompactNameIndex, LazyIndex, QueryRunner, INLINE_COST
+# Metrics records histograms of the time spent in each stage of the query path; start_logging writes sampled log records from a thread
+from charfinder_metrics import Metrics, start_logging, QUERY_LOGGER, LOG_SAMPLE
 
 CRLF = b'\r\n'
 PROMPT = b'?> '
+# A line with just this asks for the next page of the previous query
+NEXT_PAGE = '+'
+PAGE_SIZE = 50
+# A line with just this is answered with READY or LOADING, for health checks
+HEALTH = 'HEALTH'
+# A line with just this is answered with the session counters and stage timings of this server process
+STATS = 'STATS'
+# Seconds a query waits for the index to finish loading before the client is asked to retry
+READY_TIMEOUT = 2.0
+# Queries of one client in flight at once: read, being computed or waiting to be written; when full, the server stops reading from that client
+PIPELINE_DEPTH = 16
+# Longest query line in bytes; this is the StreamReader buffer limit
+READ_LIMIT = 2 ** 12
+# High-water mark of the transport write buffer; writer.drain() waits while more than this is buffered
+WRITE_LIMIT = 2 ** 16
+# Queries per second allowed to one peer (client IP address), over all its connections; 0 means no limit
+RATE_LIMIT = 2000
+# Queries a peer may send at once after being idle: the size of its token bucket
+RATE_BURST = 200
+# Connections served at once by one server process; clients beyond this are told to retry and disconnected
+MAX_CONNECTIONS = 1000
+# Seconds a client may keep the write buffer above the high-water mark before the session is dropped
+WRITE_TIMEOUT = 30.0
+# Seconds open sessions get to finish the queries already read when the server stops; the sessions left are then cut off
+DRAIN_TIMEOUT = 10.0
+# Seconds a drained session waits for the client to close after the last answer
+LINGER_TIMEOUT = 2.0
+# Seconds the sessions cut off at the drain deadline get to end once cancelled
+CANCEL_TIMEOUT = 1.0
+# A worker process that dies sooner than this after starting is restarted only after this many seconds, so a crashing worker does not fork in a tight loop
+RESTART_DELAY = 1.0
 
-# When instantiated, UnicodeNameIndex uses charfinder_index.pickle, if available, or builds it, so the first run may take a few seconds longer to start
-index = UnicodeNameIndex()
+# When instantiated, CompactNameIndex maps charfinder_index.bin, if available and built for this Unicode version, or builds it, so the first run may take a few seconds longer to be ready
+# opening the mapped file takes milliseconds and several server processes share one page-cached copy
+# LazyIndex returns immediately; index.ready tells whether the loader thread is done
+# the index times its stages (tokenize, lookup, intersect, sort) in metrics; query_page adds format, the runner the whole query and the time the loop was blocked
+metrics = Metrics()
+index = LazyIndex(CompactNameIndex, metrics=metrics)
+# index.query_cost estimates how many postings entries a page of PAGE_SIZE results reads, ROW_COST more per row formatted; above inline_cost the query goes to the executor
+# the executor is the loop's default thread pool unless serve sets a process pool (--processes)
+runner = QueryRunner(index, metrics=metrics, page_size=PAGE_SIZE)
+# Per-query log records go through this logger: print would make the event loop wait whenever stdout is slow, so records are sampled and written by a thread
+log = logging.getLogger(QUERY_LOGGER)
+# Failed answers are logged here, unsampled; without a configured handler, logging prints them on stderr
+error_log = logging.getLogger('charfinder.server')
 
-@asyncio.coroutine
-# This is the coroutine we need to pass to asyncio_startserver; the arguments received are an asyncio.StreamReader and an asyncio.StreamWriter
+# The limits of each client session, bound to handle_queries in serve
+SessionLimits = namedtuple('SessionLimits', 'rate burst max_connections write_timeout drain_timeout')
+DEFAULT_LIMITS = SessionLimits(RATE_LIMIT, RATE_BURST, MAX_CONNECTIONS, WRITE_TIMEOUT, DRAIN_TIMEOUT)
+
+# Session counters of this process, answered to STATS: sessions accepted, active, dropped (over the connection cap or too slow to read) and throttled (made to wait by the rate limit at least once), queries throttled, and answers failed with an error
+stats = Counter()
+# peer address -> [its TokenBucket, its open connections]; the bucket is shared by all connections of a peer and forgotten with the last one
+peers = {}
+# task -> (reader, writer) of each open session, so a stopping server can tell them all to finish
+sessions = {}
+# Set when the server stops: sessions that start now are turned away
+draining = asyncio.Event()
+
+
+class TokenBucket:
+    # rate tokens are added per second, up to burst tokens; each query takes one token
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def delay(self):
+        # Take a token and return the seconds to wait before using it: 0 if one was available
+        # tokens may go negative: queries waiting for tokens are a debt, paid as time passes
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Discard(asyncio.Protocol):
+    # Takes over the transport of a drained session: input is thrown away, and closed is done when the client closes or the connection is lost
+    def __init__(self):
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data):
+        pass
+
+    def eof_received(self):
+        # Returning None lets the transport close itself
+        self.connection_lost(None)
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+# The paging state of a connection after a line was answered: the query being paged, the cursor of its next page and the results sent so far
+# a cursor is just the last codepoint sent, so the intersection is never recomputed from the start
+NO_QUERY = (None, None, 0)
+
+
+def query_page(query, cursor, sent):
+    # Runs on the event loop for cheap queries, or in an executor thread or process: the query, the description lines and the status line are all done in one call
+    # returns the response bytes and the paging state after it
+    page = index.find_page(query, cursor, PAGE_SIZE)
+    # describe_lines gives the precomputed UTF-8 lines with the Unicode codepoint, the actual character and its name, i.e. b'U+0039\t9\tDIGIT NINE\r\n'; no per-row formatting or encoding happens here
+    with metrics.stage('format'):
+        lines = list(index.describe_lines(page.items))
+    sent += len(lines)
+    # Write a status line such as 627 matches for 'digit' after the last page, or a hint that more pages are available
+    if page.cursor is None:
+        status = index.status(query, sent)
+    else:
+        status = 'More results for {!r}: enter {} for the next page'.format(query, NEXT_PAGE)
+    lines.append(status.encode() + CRLF)
+    return b''.join(lines), (query, page.cursor, sent)
+
+
+async def run_page(query, cursor, sent):
+    loop = asyncio.get_running_loop()
+    response, state = await runner.run(loop, query, query_page, query, cursor, sent)
+    # Log the response: the wall time of the query, and how much of it the event loop was blocked, i.e. no other client was served
+    # the arguments are formatted only if the record is sampled
+    timing = runner.timings[-1]
+    log.info('%r: sent %d results in %.2f ms (%s, loop blocked %.2f ms)', query, state[2] - sent, timing.wall * 1000,
+             'executor' if timing.offloaded else 'inline', timing.blocking * 1000)
+    return response, state
+
+
+# A native coroutine: async def replaces @asyncio.coroutine and await replaces yield from
+# answer computes the response to one query line; previous is the task answering the line before it (None for the first line)
+# Every task returns (response bytes, paging state), so a '+' line gets the cursor from the line before it, even while several lines are in flight
+async def answer(query, previous):
+    # HEALTH reports whether the index has finished loading, without waiting for it
+    if query == HEALTH:
+        return (b'READY' if index.ready else b'LOADING') + CRLF, await paging_state(previous)
+    # STATS answers the session counters, then one line per stage: count, mean, p50 and p99 in ms, i.e. intersect count 812 mean 0.210 p50 0.128 p99 2.048
+    # percentiles are bucket bounds, powers of 2 microseconds
+    if query == STATS:
+        lines = ['{} {}'.format(name, stats[name]) for name in sorted(stats)] + metrics.report_lines()
+        return ''.join(line + '\r\n' for line in lines).encode(), await paging_state(previous)
+    loop = asyncio.get_running_loop()
+    if not index.ready:
+        # Wait for the loader thread in the default executor, so the event loop keeps serving other clients meanwhile
+        ready = await loop.run_in_executor(None, index.wait_ready, READY_TIMEOUT)
+        if not ready:
+            return b'Index still loading, try again shortly.' + CRLF, await paging_state(previous)
+    # '+' continues the previous query from its cursor; anything else starts a new query at the first page, right away, without waiting for the lines before it
+    if query == NEXT_PAGE:
+        last_query, cursor, sent = await paging_state(previous)
+        if cursor is None:
+            return b'No more results.' + CRLF, (last_query, cursor, sent)
+        return await run_page(last_query, cursor, sent)
+    return await run_page(query, None, 0)
+
+
+# The paging state after the line before: none if there was no line before, or if its answer failed
+async def paging_state(previous):
+    if previous is None:
+        return NO_QUERY
+    try:
+        return (await previous)[1]
+    except Exception:
+        return NO_QUERY
+
+
+# The response bytes of an answer task; a failed answer is logged and becomes an error line, so the session goes on with the next line
+async def response(task, query):
+    try:
+        return (await task)[0]
+    except Exception:
+        stats['errors'] += 1
+        error_log.exception('Error answering %r', query)
+        return b'Error answering the query.' + CRLF
+
+
+# This coroutine writes the answers in the order the lines were received
+# pending is an asyncio.Queue of answer tasks, ended by None
+async def write_answers(writer, pending, write_limit, write_timeout):
+    # Answers are collected in chunks and flushed when the next answer is not ready yet, or when write_limit bytes are collected: one drain per batch instead of one per prompt, and never more than write_limit bytes held here
+    chunks = []
+    buffered = 0
+
+    async def flush():
+        nonlocal buffered
+        # .writelines() writes a list (or any iterable) of bytes to the stream
+        writer.writelines(chunks)
+        chunks.clear()
+        buffered = 0
+        # StreamWriter.drain waits until the transport write buffer is below its high-water mark; it is a coroutine, so it must be awaited
+        # a client that reads nothing for write_timeout seconds is dropped: its answers would otherwise pile up in server memory
+        try:
+            await asyncio.wait_for(writer.drain(), write_timeout)
+        except asyncio.TimeoutError:
+            stats['dropped'] += 1
+            # abort discards the write buffer and closes the socket at once; the reader then sees end of file
+            writer.transport.abort()
+            raise ConnectionAbortedError('client too slow')
+
+    # The StreamWriter.write method is not a coroutine, just a plain function; this sends the first ?> prompt
+    writer.write(PROMPT)
+    try:
+        while True:
+            if chunks and pending.empty():
+                await flush()
+            task = await pending.get()
+            if task is None:
+                break
+            if chunks and not task.done():
+                await flush()
+            chunks.append(await response(task, task.get_name()) + PROMPT)
+            buffered += len(chunks[-1])
+            if buffered >= write_limit:
+                await flush()
+        if chunks:
+            await flush()
+    except ConnectionError:
+        # The client is gone: keep emptying the queue, so handle_queries never waits on a full one
+        while await pending.get() is not None:
+            pass
+
+
+# This is the coroutine we pass to asyncio.start_server; the arguments received are an asyncio.StreamReader and an asyncio.StreamWriter
 # asyncio.StreamReader: represents a reader object that provides API to read data from the IO stream
 # asyncio.StreamWriter: represents a writer object that provides APIs to write data to the IO stream
-def handle_queries(reader, writer):
-    # This loop handles a session which lasts until any control character is received from the client
+# pipeline, write_limit and limits are bound with functools.partial in serve
+async def handle_queries(reader, writer, pipeline=PIPELINE_DEPTH, write_limit=WRITE_LIMIT, limits=DEFAULT_LIMITS):
+    # Over the connection cap, the client gets a one line answer instead of a session
+    if stats['active'] >= limits.max_connections or draining.is_set():
+        stats['dropped'] += 1
+        writer.write(b'Server busy, try again later.' + CRLF)
+        writer.close()
+        return
+    stats['accepted'] += 1
+    stats['active'] += 1
+    # This returns the remote address to which the socket is connected
+    # get_extra_info(): access optional transport information
+    client = writer.get_extra_info('peername')
+    peer = client[0] if client else None
+    if peer not in peers:
+        peers[peer] = [TokenBucket(limits.rate, limits.burst), 0]
+    peers[peer][1] += 1
+    sessions[asyncio.current_task()] = reader, writer
+    try:
+        await serve_session(reader, writer, client, peers[peer][0], pipeline, write_limit, limits)
+    # Cancelled by drain at its deadline: ending normally keeps start_server from logging the cancellation as an error
+    except asyncio.CancelledError:
+        if not draining.is_set():
+            raise
+    finally:
+        del sessions[asyncio.current_task()]
+        stats['active'] -= 1
+        peers[peer][1] -= 1
+        if not peers[peer][1]:
+            del peers[peer]
+
+
+# One client session: bucket is the TokenBucket of the client address
+async def serve_session(reader, writer, client, bucket, pipeline, write_limit, limits):
+    writer.transport.set_write_buffer_limits(high=write_limit)
+    throttled = False
+    # A bounded queue: when pipeline answers are pending, pending.put waits, so this client's lines stay unread in the socket
+    pending = asyncio.Queue(pipeline)
+    writing = asyncio.create_task(write_answers(writer, pending, write_limit, limits.write_timeout))
+    previous = None
+    # This loop handles a session which lasts until any control character or end of file is received from the client
     while True:
-        # The StreamWriter.write method is not a coroutine, just a plain function; this line sends the ?> prompt (writes the data to the stream)
-        # can NOT yield from
-        writer.write(PROMPT)
-        # SteamWriter.drain flushes the writer buffer; it is a coroutine, so it must be called with yield from
-        # MUST yield from
-        yield from writer.drain()
+        # The client is gone, or the session was cut off: the lines still buffered are not worth answering
+        if writer.transport.is_closing():
+            break
         # StreamReader.readline is a coroutine; it returns bytes
-        data = yield from reader.readline()
+        try:
+            data = await reader.readline()
+        # A line longer than the read limit raises ValueError; its bytes are discarded
+        except ValueError:
+            previous = asyncio.create_task(too_long(previous))
+            await pending.put(previous)
+            continue
+        except ConnectionError:
+            break
+        # An empty bytes object means end of file: the client closed its side
+        if not data:
+            break
         try:
             query = data.decode().strip()
         # A UnicodeDecodeError may happen when the Telnet client sends control characters; if that happens, we pretend a null character was sent, for simplicity
         except UnicodeDecodeError:
             query = '\x00'
-        # This returns the remote address to which the socket is connected
-        # get_extra_info(): access optional transport information
-        client = writer.get_extra_info('peername')
-        # Log the query to the server console
-        print('Received from {}: {!r}'.format(client, query))
-        if query:
-            # Exit the loop if a control or null character was received
-            # chr(32), chr(31) . . . and below return no output (no characters are assigned therefore it will be null if the number is below 32)
-            # note: chr() is the opposite of ord()
-            if ord(query[:1]) < 32:
-                break
-            # This returns a generator that yields strings with the Unicode codepoint, the actual character and its name, i.e. U+0039\t9\tDIGIT NINE; for simplicity I build a list from it
-            lines = list(index.find_description_strs(query))
-            if lines:
-                # Send the lines converted to bytes using the default UTF-8 encoding, appending a carriage return and a line feed to each; note that the argument is a generator expression
-                # .writelines() writes a list (or any iterable) of bytes to the stream
-                writer.writelines(line.encode() + CRLF for line in lines)
-            # Write a status line such as 627 matches for 'digit'
-            writer.write(index.status(query, len(lines)).encode() + CRLF)
-
-            # Flush the output buffer
-            yield from writer.drain()
-            # Log the response to the server console 
-            print('Sent {} results'.format(len(lines)))
-
-    # Log the end of the session to the server console
-    print('Close the client socket')
+        if not query:
+            continue
+        # Exit the loop if a control or null character was received
+        # chr(32), chr(31) . . . and below return no output (no characters are assigned therefore it will be null if the number is below 32)
+        # note: chr() is the opposite of ord()
+        if ord(query[:1]) < 32:
+            break
+        # Over its rate, a peer waits for a token before its query is answered; meanwhile its next lines stay unread, so the wait pushes back on the client through TCP
+        delay = bucket.delay() if limits.rate else 0
+        if delay:
+            stats['throttled_queries'] += 1
+            if not throttled:
+                throttled = True
+                stats['throttled'] += 1
+            await asyncio.sleep(delay)
+        # The answer starts computing now, while the lines after it are read; the task is named after the query, for the error log
+        previous = asyncio.create_task(answer(query, previous), name=query)
+        await pending.put(previous)
+
+    # Let the answers already read be written, then stop the writer
+    await pending.put(None)
+    await writing
+    log.info('Closed session of %s', client)
+    if draining.is_set():
+        await linger(writer)
+        return
     # Close the StreamWriter
     writer.close()
 
 
+# Closing a socket while the client's next lines are still unread makes the kernel send a reset, which may destroy answers the client has not read yet
+# so a drained session shuts down its sending side only: the client reads every answer, then end of file; its unread lines are discarded until it closes too
+async def linger(writer):
+    transport = writer.transport
+    if transport.is_closing():
+        return
+    discard = Discard()
+    # write_eof sends FIN once the buffered answers are sent
+    writer.write_eof()
+    transport.set_protocol(discard)
+    transport.resume_reading()
+    try:
+        await asyncio.wait_for(discard.closed, LINGER_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    transport.close()
+
+
+async def too_long(previous):
+    return b'Query too long.' + CRLF, await paging_state(previous)
+
+
 '''
 all I/O in the example above is in bytes (default encoding UTF-8):
     1. decode the strings received from the network
     2. encode the strings sent out
 
-some of the I/O are coroutines and must be driven with "yield from" while others are simple functions
+some of the I/O are coroutines and must be awaited while others are simple functions
 *asyncio docs label which methods/functions are coroutines and which are not
 
+pipelining: a client may send several lines without waiting for the answers
+    each line becomes a task right away; cheap queries are answered on the event loop, expensive ones concurrently in executor threads
+
+cost-based offloading: a query costs the postings entries index.query_cost estimates its page reads, without computing it
+    handing a query to a thread takes tens of microseconds, more than answering 'sun' from its postings, so only queries above --inline-cost leave the loop
+    'U+0000..U+10FFFF' or a typo pattern like 'bishopp~' would block every other client for milliseconds; these go to the executor
+    the server log shows, per query, the wall time and the time the loop was blocked; the totals are printed on shutdown
+    the answers are written in the order of the lines, batched, with one drain per batch
+
+session limits: one client must not be able to exhaust the server
+    answers are batched up to write_limit bytes, and drain waits while the transport buffer is above write_limit, so a client that reads slowly holds at most about twice write_limit bytes of answers
+    a client that reads nothing for --write-timeout seconds is dropped
+    each client address has a token bucket: beyond --rate queries per second (after a --burst), its queries wait, and so does reading its next lines
+    beyond --max-connections sessions, new clients are turned away; STATS answers the counters of all this
+
 take a look at def main(): in tcp_charfinder.py below
 '''
 
 
-# tcp_charfinder.py (continued): main function sets up and tears down the event loop and the socket server
-
-# the main function can be called with NO arguments because default arguments are set already
-def main(address='127.0.0.1', port=2323):
-    port = int(port)
-    # asyncio creates a new event loop and sets it as the current one
-    loop = asyncio.get_event_loop()
-    # when completed, the coroutine object returned by asyncio.start_server returns an instance of asyncio.Server, a TCP socket server
-    server_coro = asyncio.start_server(handle_queries, address, port, loop=loop)
-    # Drive server_coro to bring up the server
-    server = loop.run_until_complete(server_coro)
+# tcp_charfinder.py (continued): main function starts the socket server and runs it until CTRL-C
 
+async def serve(address, port, pipeline, read_limit, write_limit, processes=None, limits=DEFAULT_LIMITS,
+                log_sample=LOG_SAMPLE, reuse_port=False):
+    # Started here, so each worker process has its own logging thread; a thread does not survive a fork
+    listener = start_logging(log_sample)
+    if processes:
+        # Threads share the GIL with the event loop, so a pure Python query in a thread still slows the loop down; processes do not
+        # the pool forks after the index is loaded, so its processes inherit the mapped file and start ready; each has its own result cache
+        index.wait()
+        runner.executor = futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+    handler = functools.partial(handle_queries, pipeline=pipeline, write_limit=write_limit, limits=limits)
+    # asyncio.start_server is a coroutine; awaiting it returns an instance of asyncio.Server, a TCP socket server
+    # limit is the buffer limit of each StreamReader
+    # reuse_port sets SO_REUSEPORT: several processes may listen on the same address and port, and the kernel spreads the connections among them
+    server = await asyncio.start_server(handler, address, port, limit=read_limit, reuse_port=reuse_port)
     # Get address and port of the first socket of the server and ...
     # .getsockname() returns (ip, port)
     host = server.sockets[0].getsockname()
     # ... display it on the server console. This is the first output generated by this script on the server console
-    print('Serving on {}. Hit CTRL-C to stop.'.format(host))
+    print('Serving on {} in process {}. Hit CTRL-C to stop.'.format(host, os.getpid()))
+    # CTRL-C (SIGINT) and SIGTERM set the stopping event instead of interrupting whatever code is running; further signals are ignored while draining
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    started = None
+    try:
+        # start_server already accepts connections; serve waits here until a signal arrives
+        await stopping.wait()
+        started = time.monotonic()
+        await drain(server, limits.drain_timeout)
+    finally:
+        listener.stop()
+        print(runner.report())
+        print('Sessions: {}'.format(', '.join('{} {}'.format(name, stats[name]) for name in sorted(stats))))
+        if runner.executor is not None:
+            runner.executor.shutdown(cancel_futures=True)
+        if started is not None:
+            print('Shutdown took {:.3f}s'.format(time.monotonic() - started))
+
+
+# Graceful shutdown: stop accepting, let the open sessions answer the lines they already read, close them, and cut off those still open after drain_timeout seconds
+async def drain(server, drain_timeout):
+    t0 = time.monotonic()
+    draining.set()
+    # Server.close closes the listening sockets only; the sessions already accepted go on
+    # with --reuse-port, another server process on the same port takes the new connections from now on
+    server.close()
+    open_sessions = len(sessions)
+    print('Draining {} sessions, for up to {}s'.format(open_sessions, drain_timeout))
+    for reader, writer in sessions.values():
+        # No more lines are read from the socket; feed_eof makes readline return the lines already buffered, then b'' as if the client closed its side
+        # the session then writes the answers still pending and closes, as it does at end of file
+        writer.transport.pause_reading()
+        reader.feed_eof()
+    cut_off = set()
+    if sessions:
+        _, cut_off = await asyncio.wait(list(sessions), timeout=drain_timeout)
+    # Past the deadline, abort closes the socket without writing what is left, and cancel ends the session even if it waits on something else than the socket, e.g. a query that never returns
+    for task in cut_off:
+        sessions[task][1].transport.abort()
+        task.cancel()
+    if cut_off:
+        await asyncio.wait(cut_off, timeout=CANCEL_TIMEOUT)
+    await server.wait_closed()
+    stats['drained'] += open_sessions - len(cut_off)
+    stats['cut_off'] += len(cut_off)
+    print('Drained {} sessions in {:.3f}s; {} cut off at the deadline'.format(
+          open_sessions - len(cut_off), time.monotonic() - t0, len(cut_off)))
+
+
+# tcp_charfinder.py (continued): with --workers N, a parent process forks N workers, each one a whole server with its own event loop
+
+def spawn_worker(*server_args):
+    # os.fork returns 0 in the child and the child's pid in the parent
+    pid = os.fork()
+    if pid:
+        return pid
+    # In the child: SIGTERM from the parent makes the worker drain and stop (see serve), and os._exit makes sure the child never returns into the parent's supervising loop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+        asyncio.run(serve(*server_args, reuse_port=True))
+    except KeyboardInterrupt:
+        pass
+    except BaseException as exc:
+        print('Worker {} failed: {!r}'.format(os.getpid(), exc), file=sys.stderr)
+        status = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(status)
+
+
+def supervise(workers, *server_args):
+    # Load the index in the parent before forking: the workers inherit the mapped file, so all of them share one page-cached copy and start ready
+    index.wait()
+    # pid -> (worker number, start time) of the running workers
+    children = {}
+
+    def start(number):
+        children[spawn_worker(*server_args)] = number, time.monotonic()
+
+    # SIGTERM to the parent raises SystemExit, so the finally clause below stops the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        # run the event loop; this is where main will block until killed when ctrl-c is pressed on the server console
-        loop.run_forever()
-    # ctrl + c pressed
-    except KeyboardInterrupt: 
+        for number in range(workers):
+            start(number)
+        while True:
+            # os.wait blocks until any child exits; then restart it
+            pid, status = os.wait()
+            number, started = children.pop(pid)
+            print('Worker {} (pid {}) exited with status {}; restarting'.format(
+                  number, pid, os.waitstatus_to_exitcode(status)))
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            start(number)
+    except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        # Each worker drains its own sessions; waiting for all of them takes at most about the drain timeout
+        t0 = time.monotonic()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+        print('Workers stopped in {:.3f}s'.format(time.monotonic() - t0))
 
+
+# the main function can be called with NO arguments because default arguments are set already
+def main(address='127.0.0.1', port=2323, pipeline=PIPELINE_DEPTH,
+         read_limit=READ_LIMIT, write_limit=WRITE_LIMIT, workers=None,
+         processes=None, inline_cost=INLINE_COST, limits=DEFAULT_LIMITS, log_sample=LOG_SAMPLE,
+         reuse_port=False):
+    port = int(port)
+    runner.inline_cost = inline_cost
+    server_args = address, port, pipeline, read_limit, write_limit, processes, limits, log_sample
+    if workers is not None and workers > 1:
+        supervise(workers, *server_args)
+        print('Server shutting down.')
+        return
+    # asyncio.run creates an event loop, runs the coroutine until it is done and closes the loop
+    # ctrl + c pressed: serve drains the sessions and returns
+    asyncio.run(serve(*server_args, reuse_port=reuse_port))
     print('Server shutting down.')
-    # close the server 
-    server.close()
-    # server.wait_closed() returns a future; use loop.run_until_complete to let the future do its job
-    loop.run_until_complete(server.wait_closed())
-    # terminate the event loop
-    loop.close()
 
 if __name__ == "__main__":
-    main(*sys.argv[1:])
+    parser = argparse.ArgumentParser(description='Unicode character finder TCP server.')
+    parser.add_argument('address', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', nargs='?', type=int, default=2323)
+    parser.add_argument('--pipeline', type=int, default=PIPELINE_DEPTH,
+                        help='queries in flight per client (default: %(default)s)')
+    parser.add_argument('--read-limit', type=int, default=READ_LIMIT,
+                        help='longest query line in bytes (default: %(default)s)')
+    parser.add_argument('--write-limit', type=int, default=WRITE_LIMIT,
+                        help='write buffer high-water mark in bytes (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='server processes sharing the port with SO_REUSEPORT (default: 1)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='run expensive queries in a pool of this many processes instead of threads')
+    parser.add_argument('--inline-cost', type=int, default=INLINE_COST,
+                        help='estimated postings entries above which a query leaves the event loop (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=RATE_LIMIT,
+                        help='queries per second per client address, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--burst', type=int, default=RATE_BURST,
+                        help='queries a client address may send at once (default: %(default)s)')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='clients served at once per process (default: %(default)s)')
+    parser.add_argument('--write-timeout', type=float, default=WRITE_TIMEOUT,
+                        help='seconds a client may leave answers unread before it is dropped (default: %(default)s)')
+    parser.add_argument('--log-sample', type=float, default=LOG_SAMPLE,
+                        help='fraction of queries logged, 1 for all (default: %(default)s)')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help='seconds open sessions get to finish on CTRL-C or SIGTERM (default: %(default)s)')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='listen with SO_REUSEPORT, so a new server can start on the port before this one stops')
+    args = parser.parse_args()
+    limits = SessionLimits(args.rate, args.burst, args.max_connections, args.write_timeout, args.drain_timeout)
+    main(args.address, args.port, args.pipeline, args.read_limit, args.write_limit, args.workers,
+         args.processes, args.inline_cost, limits, args.log_sample, args.reuse_port)
 
 
 '''
-note: run_until_complete() accepts either a coroutine (result of start_server) or a future (result of server.wait_closed) 
-    if coroutine --> wraps coroutine in a Task
+note: asyncio.run() replaces get_event_loop(), run_until_complete() and close()
+    loop.add_signal_handler runs a callback in the event loop when a signal arrives, instead of raising KeyboardInterrupt wherever the code happens to be
+
+graceful shutdown: on CTRL-C or SIGTERM the server stops accepting and drains
+    open sessions answer the lines already read, then close; sessions still open after --drain-timeout are cut off
+    the number of sessions drained and cut off, and how long draining and the whole shutdown took, are printed
+    zero-downtime deploy: start the new server with --reuse-port on the same port, then SIGTERM the old one, also started with --reuse-port
+    clients read every answer to the lines the server read, then end of file; they reconnect, to the new server, and send again the lines left unanswered
+    the answers come in the order of the lines, so a client knows which lines were not answered
+
+with --workers N, one event loop per process serves the clients the kernel hands to it
+    the index is loaded and mapped before forking, so the workers share the same memory pages
+    the parent only supervises: it restarts a worker that dies and stops all of them on CTRL-C or SIGTERM
 
 take a look at the output of tcp_charfinder.py below to get a sense of control flow
 '''
@@ -122,28 +594,26 @@ take a look at the output of tcp_charfinder.py below to get a sense of control f
 
 # tcp_charfinder.py (continued): server side of the session depicted in figure 18-2
 
-# $ python3 tcp_charfinder.py
+# $ python3 tcp_charfinder.py --log-sample 1
 # This is the output of main()
-# Serving on ('127.0.0.1', 2323). Hit CTRL-C to stop.
+# Serving on ('127.0.0.1', 2323) in process 4242. Hit CTRL-C to stop.
 
-# First iteration of the while loop in handle_queries
-# Received from ('127.0.0.1', 62910): 'chess black'
-# Sent 6 results
+# First line answered; the log records come from the logging thread, with time and process id
+# 2024-05-01 10:00:00,123 4242 'chess black': sent 6 results in 0.41 ms (inline, loop blocked 0.41 ms)
 
-# Second iteration of the while loop
-# Received from ('127.0.0.1', 62910): 'sun'
-# Sent 10 results
+# Second line
+# 2024-05-01 10:00:02,456 4242 'sun': sent 10 results in 0.15 ms (inline, loop blocked 0.15 ms)
 
 # The user hit CTRL-C; the server receives a control character and closes the session
-# Received from ('127.0.0.1', 62910): '\x00'
-
 # The client socket is closed but the server is still running, ready to service another client
-# Close the client socket
+# 2024-05-01 10:00:05,789 4242 Closed session of ('127.0.0.1', 62910)
+
+# with the default --log-sample 0.01, about one query in a hundred is logged; STATS has the counts and timings of all of them
 
 
 '''
-note: main() almost immediately displays the Serving on . . . message and blocks in the loop.run_forever() call
-    control flows into the event loop and STAYS there, occasionally coming back to handle_queries coroutine, which yields control BACK to the event loop whenever it needs to wait for the network as it sends or receives data
+note: main() almost immediately displays the Serving on . . . message and blocks in asyncio.run()
+    control flows into the event loop and STAYS there, occasionally coming back to the handle_queries, answer and write_answers coroutines, which yield control BACK to the event loop whenever they await the network or an executor thread
 
 asyncio.Stream . . . : provides a ready to use server so you only need to implement a handler function (plain callback or a coroutine)
-'''
\ No newline at end of file
+'''